@@ -3,14 +3,147 @@
 import sqlite3
 import os
 import datetime
-import argparse
-import subprocess
+import contextlib
+import io
+import sys
+import socket
 import re
-from tabulate import tabulate
-from termcolor import colored
-from configparser import ConfigParser
+import json
+import glob
+import time
+import hashlib
+import atexit
+import functools
+import importlib
+import importlib.util
+import html as html_escape
+from decimal import Decimal
+
+# Heavier modules are imported where they are used, so that quick commands
+# do not pay for the ones they never touch
+bean_loader = bean_data = bean_parser = bean_booking = bean_printer = None
+
+
+def load_beancount():
+    '''Import the beancount modules used by the in-process backend'''
+    global bean_loader, bean_data, bean_parser, bean_booking, bean_printer
+    if bean_loader == None:
+        from beancount import loader as bean_loader
+        from beancount.core import data as bean_data
+        from beancount.parser import parser as bean_parser
+        from beancount.parser import booking as bean_booking
+        from beancount.parser import printer as bean_printer
+
+
+def optional_module(name):
+    '''Import an optional dependency, or return None if it is not installed'''
+    try:
+        return(importlib.import_module(name))
+    except ImportError:
+        return(None)
+
+
+def tabulate(*args, **kwargs):
+    from tabulate import tabulate as render
+    return(render(*args, **kwargs))
+
+
+def colored(*args, **kwargs):
+    from termcolor import colored as render
+    return(render(*args, **kwargs))
 
 config_file = os.path.expandvars("$HOME/.config/beanvelope/beanvelope.conf")
+cache_file = "$HOME/.cache/beanvelope/ledger_cache.db"
+socket_file = "$HOME/.cache/beanvelope/beanvelope.sock"
+
+# Detailed corrections of compacted budgets; also created in attached archive databases
+archive_schema = '''create table if not exists {schema}.corrections_archive
+        (budget_id integer,
+        account_id integer,
+        correction_type char,
+        correction_value integer,
+        archived text);
+    create index if not exists {schema}.corrections_archive_idx
+        on corrections_archive (budget_id, account_id);'''
+
+# The 'C' carries into each budget and account, including those of compacted
+# budgets in {schema}.corrections_archive; shared by audit, history and reports
+carries_cte = '''carries as
+    (select budget_id, account_id, sum(correction_value) as carried
+     from (select budget_id, account_id, correction_value from corrections
+           where correction_type = 'C'
+           union all
+           select budget_id, account_id, correction_value from {schema}.corrections_archive
+           where correction_type = 'C')
+     group by budget_id, account_id)'''
+
+# Schema upgrades applied on top of beanvelope.sql, tracked by PRAGMA user_version.
+# Append new migrations to the end; never edit one that has been released.
+migrations = [
+    # 1: ledger aggregates and their high-water mark
+    '''create table if not exists ledger_files
+        (path text primary key,
+        size integer,
+        mtime integer,
+        digest text);
+    create table if not exists ledger_monthly
+        (kind char,
+        year integer,
+        month integer,
+        account_name text,
+        value integer,
+        currency text,
+        primary key (kind, year, month, account_name));''',
+    # 2: covering indexes for envelope_balance, base_planner and update_missing
+    '''create index if not exists corrections_budget_idx
+        on corrections (budget_id, account_id, correction_type, correction_value);
+    create index if not exists corrections_account_idx
+        on corrections (account_id, budget_id);
+    create index if not exists budget_base_account_idx
+        on budget_base (account_id);''',
+    # 3: per-budget correction totals kept current by triggers on corrections
+    '''create table if not exists envelope_totals
+        (budget_id integer,
+        account_id integer,
+        total_correction integer default 0,
+        primary key (budget_id, account_id));
+    create trigger if not exists envelope_totals_insert after insert on corrections
+    begin
+        insert into envelope_totals values (new.budget_id, new.account_id, new.correction_value)
+        on conflict (budget_id, account_id)
+        do update set total_correction = total_correction + excluded.total_correction;
+    end;
+    create trigger if not exists envelope_totals_delete after delete on corrections
+    begin
+        update envelope_totals set total_correction = total_correction - old.correction_value
+        where budget_id = old.budget_id and account_id = old.account_id;
+    end;
+    create trigger if not exists envelope_totals_update after update on corrections
+    begin
+        update envelope_totals set total_correction = total_correction - old.correction_value
+        where budget_id = old.budget_id and account_id = old.account_id;
+        insert into envelope_totals values (new.budget_id, new.account_id, new.correction_value)
+        on conflict (budget_id, account_id)
+        do update set total_correction = total_correction + excluded.total_correction;
+    end;
+    delete from envelope_totals;
+    insert into envelope_totals
+        select budget_id, account_id, sum(correction_value)
+        from corrections group by budget_id, account_id;''',
+    # 4: the ledger's expense/liability accounts from Open/Close directives;
+    # clearing the high-water mark forces a full sync to fill it
+    '''create table if not exists ledger_accounts
+        (account_name text primary key,
+        open_date text,
+        close_date text);
+    delete from ledger_files;''',
+    # 5: sync bookkeeping, such as the filter_mods signature the aggregates were built with
+    '''create table if not exists sync_state
+        (key text primary key,
+        value text);''',
+    # 6: detailed corrections moved out of the hot table by compact_corrections
+    archive_schema.format(schema="main"),
+    ]
 
 def db_in(value):
     a=str(value)
@@ -49,9 +182,21 @@ def db_out(value):
     return(result)
 
 class position:
-    def __init__(self, line):
-        line = line.strip()
-        self.account, self.value, self.currency = line.split()
+    def __init__(self, line=None, account=None, value=None, currency=None, year=None, month=None, kind=None, grouped=False):
+        self.year, self.month, self.kind = year, month, kind
+        if line == None:
+            self.account, self.value, self.currency = account, value, currency
+            return
+        fields = line.strip().split()
+        if grouped:
+            self.year, self.month = int(fields[0]), int(fields[1])
+            fields = fields[2:]
+        self.account = fields[0]
+        if len(fields) == 1:
+            # bean-query prints an empty inventory for positions summing to zero
+            self.value, self.currency = "0", None
+        else:
+            self.value, self.currency = fields[1], fields[2]
 
     def get_account(self):
         return(self.account)
@@ -59,8 +204,419 @@ class position:
     def get_value(self):
         return(self.value)
 
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(65536), b''):
+            digest.update(block)
+    return(digest.hexdigest())
+
+
+def ledger_includes(beanfile):
+    '''Return beanfile and every file it includes, following include directives'''
+    include_re = re.compile(r'^include\s+"([^"]+)"', re.M)
+    found = []
+    pending = [os.path.abspath(beanfile)]
+    while pending:
+        path = pending.pop()
+        if path in found:
+            continue
+        found.append(path)
+        with open(path, 'r') as source:
+            text = source.read()
+        for pattern in include_re.findall(text):
+            pattern = os.path.join(os.path.dirname(path), pattern)
+            pending.extend(sorted(glob.glob(pattern)))
+    return(found)
+
+
+def compile_filter(text):
+    '''Compile one filter_mods entry into an (action, target, conditions) rule
+
+    Entries take the form "exclude <condition>..." or
+    "reassign <account> [<condition>...]", where each condition is one of
+    tag:NAME, link:NAME, payee:REGEX or narration:REGEX and all conditions
+    must match. Returns None if the text is not a valid filter.'''
+    words = text.split()
+    if len(words) < 2:
+        return(None)
+    if words[0] == 'exclude':
+        target, conditions = None, words[1:]
+    elif words[0] == 'reassign':
+        target, conditions = words[1], words[2:]
+    else:
+        return(None)
+    rule = []
+    for word in conditions:
+        field, sep, value = word.partition(':')
+        if field not in ('tag', 'link', 'payee', 'narration') or value == '' or "'" in value:
+            return(None)
+        rule.append((field, value))
+    return((words[0], target, rule))
+
+
+def filter_matches(conditions, txn):
+    for field, value in conditions:
+        if field == 'tag':
+            matched = value in txn.tags
+        elif field == 'link':
+            matched = value in txn.links
+        elif field == 'payee':
+            matched = re.search(value, txn.payee or '') != None
+        else:
+            matched = re.search(value, txn.narration or '') != None
+        if not matched:
+            return(False)
+    return(True)
+
+
+def filter_condition_sql(conditions):
+    '''Translate filter conditions into a bean-query expression'''
+    terms = []
+    for field, value in conditions:
+        if field == 'tag':
+            terms.append("'{}' in tags".format(value))
+        elif field == 'link':
+            terms.append("'{}' in links".format(value))
+        else:
+            terms.append("{} ~ '{}'".format(field, value))
+    return(' and '.join(terms))
+
+
+class ledger_cache:
+    '''On-disk cache of ledger query results, keyed on the ledger's source files'''
+    def __init__(self, path, beanfile, max_entries=64):
+        self.beanfile = os.path.abspath(beanfile)
+        self.max_entries = max_entries
+        self.fingerprint = None
+        self.checked = False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.dbobject = sqlite3.connect(path)
+        # Batch workers and the daemon share one cache file, so set it up
+        # like the budget database
+        self.dbobject.execute('pragma journal_mode = wal')
+        self.dbobject.execute('pragma synchronous = normal')
+        self.dbobject.execute('pragma busy_timeout = 5000')
+        self.dbobject.executescript('''
+            create table if not exists cache_files
+                (beanfile text,
+                path text,
+                mtime integer,
+                size integer,
+                digest text,
+                primary key (beanfile, path));
+            create table if not exists cache_entries
+                (fingerprint text,
+                query text,
+                results text,
+                last_used real,
+                primary key (fingerprint, query));
+            ''')
+
+    def close(self):
+        self.dbobject.close()
+
+    def reset(self):
+        '''Forget the checked fingerprint, so the next lookup checks the source files again'''
+        self.fingerprint = None
+        self.checked = False
+
+    def make_fingerprint(self, files):
+        digest = hashlib.sha256(self.beanfile.encode('utf-8'))
+        for path, file_hash in sorted(files):
+            digest.update(path.encode('utf-8'))
+            digest.update(file_hash.encode('utf-8'))
+        return(digest.hexdigest())
+
+    def check_files(self):
+        '''Return the ledger fingerprint if no recorded source file has changed, else None'''
+        sql = '''select path, mtime, size, digest from cache_files where beanfile = ?'''
+        rows = self.dbobject.execute(sql, [self.beanfile]).fetchall()
+        if len(rows) == 0:
+            return(None)
+        files = []
+        for path, mtime, size, digest in rows:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return(None)
+            if stat.st_mtime_ns != mtime or stat.st_size != size:
+                # Touched but possibly unchanged, fall back to the content hash
+                if file_digest(path) != digest:
+                    return(None)
+                sql = '''update cache_files set mtime = ?, size = ?
+                         where beanfile = ? and path = ?'''
+                self.dbobject.execute(sql, [stat.st_mtime_ns, stat.st_size, self.beanfile, path])
+                self.dbobject.commit()
+            files.append((path, digest))
+        return(self.make_fingerprint(files))
+
+    def record_files(self, paths):
+        '''Record the source files of a freshly parsed ledger and drop stale results'''
+        files = []
+        rows = []
+        for path in paths:
+            stat = os.stat(path)
+            digest = file_digest(path)
+            files.append((path, digest))
+            rows.append((self.beanfile, path, stat.st_mtime_ns, stat.st_size, digest))
+        self.fingerprint = self.make_fingerprint(files)
+        self.checked = True
+        sql = '''select path, digest from cache_files where beanfile = ?'''
+        previous = self.dbobject.execute(sql, [self.beanfile]).fetchall()
+        if len(previous) > 0 and self.make_fingerprint(previous) != self.fingerprint:
+            sql = '''delete from cache_entries where fingerprint = ?'''
+            self.dbobject.execute(sql, [self.make_fingerprint(previous)])
+        self.dbobject.execute('''delete from cache_files where beanfile = ?''', [self.beanfile])
+        self.dbobject.executemany('''insert into cache_files values (?,?,?,?,?)''', rows)
+        self.dbobject.commit()
+
+    def get(self, query):
+        if not self.checked:
+            self.fingerprint = self.check_files()
+            self.checked = True
+        if self.fingerprint == None:
+            return(None)
+        sql = '''select results from cache_entries where fingerprint = ? and query = ?'''
+        row = self.dbobject.execute(sql, [self.fingerprint, query]).fetchone()
+        if row == None:
+            return(None)
+        sql = '''update cache_entries set last_used = ? where fingerprint = ? and query = ?'''
+        self.dbobject.execute(sql, [time.time(), self.fingerprint, query])
+        self.dbobject.commit()
+        return(json.loads(row[0]))
+
+    def put(self, query, results):
+        sql = '''insert or replace into cache_entries values (?,?,?,?)'''
+        self.dbobject.execute(sql, [self.fingerprint, query, json.dumps(results), time.time()])
+        # Evict the least recently used entries beyond the size bound
+        sql = '''delete from cache_entries where rowid not in
+                    (select rowid from cache_entries order by last_used desc limit ?)'''
+        self.dbobject.execute(sql, [self.max_entries])
+        self.dbobject.commit()
+
+
+# Report queries for export_report. Each row is year, month, then the
+# columns; the last three columns are amounts and the last one is colored.
+# {schema} holds corrections_archive, for carries of compacted budgets.
+report_queries = {
+    "balances": (["ID", "Account", "Target", "Spend", "Balance"],
+        '''select m.year, m.month, a.account_id, a.account_name, b.target, b.spending,
+                  b.base_value + c.total_correction - b.spending
+           from budgets m
+           join budget_base b on b.budget_id = m.budget_id
+           join accounts a on a.account_id = b.account_id
+           join envelope_totals c on c.budget_id = b.budget_id and c.account_id = b.account_id
+           where m.year*12 + m.month between ? and ?
+           order by m.year, m.month, a.account_name'''),
+    "planner": (["ID", "Account", "Target", "Carried", "Allocated"],
+        '''with ''' + carries_cte + '''
+           select m.year, m.month, a.account_id, a.account_name, b.target,
+                  coalesce(c.carried, 0), b.base_value
+           from budgets m
+           join budget_base b on b.budget_id = m.budget_id
+           join accounts a on a.account_id = b.account_id
+           left join carries c on c.budget_id = b.budget_id and c.account_id = b.account_id
+           where m.year*12 + m.month between ?1 and ?2
+           order by m.year, m.month, a.account_name'''),
+    }
+
+
+# Invariant checks run by audit. Each query returns budget_id, year, month,
+# account_id, account_name, expected and found for every discrepancy.
+audit_checks = [
+    ("allocation",
+     '''select m.budget_id, m.year, m.month, null, null, i.income, sum(b.base_value)
+        from budgets m
+        join income i on i.budget_id = m.budget_id
+        join budget_base b on b.budget_id = m.budget_id
+        where m.active = 1
+        group by m.budget_id
+        having i.income != sum(b.base_value)'''),
+    ("carry",
+     '''with totals as
+            (select budget_id, account_id, sum(correction_value) as total
+             from corrections group by budget_id, account_id),
+        ''' + carries_cte + ''',
+        unverifiable as
+            (select budget_id from corrections where correction_type = 'Z'
+             except select budget_id from carries)
+        select nb.budget_id, nb.year, nb.month, b.account_id, a.account_name,
+            b.base_value + coalesce(t.total, 0) - b.spending, coalesce(k.carried, 0)
+        from budgets cb
+        join budgets nb on nb.year*12 + nb.month = cb.year*12 + cb.month + 1
+        join budget_base b on b.budget_id = cb.budget_id
+        join accounts a on a.account_id = b.account_id
+        left join totals t on t.budget_id = b.budget_id and t.account_id = b.account_id
+        left join carries k on k.budget_id = nb.budget_id and k.account_id = b.account_id
+        where cb.closed = 1
+        and nb.budget_id not in (select budget_id from unverifiable)
+        and b.base_value + coalesce(t.total, 0) - b.spending != coalesce(k.carried, 0)'''),
+    ("orphan",
+     '''select c.budget_id, m.year, m.month, c.account_id, a.account_name, null, sum(c.correction_value)
+        from corrections c
+        left join budgets m on m.budget_id = c.budget_id
+        left join accounts a on a.account_id = c.account_id
+        left join budget_base b on b.budget_id = c.budget_id and b.account_id = c.account_id
+        where b.budget_id is null
+        group by c.budget_id, c.account_id'''),
+    ("transfer",
+     '''select t.budget_id, m.year, m.month, null, null, 0, sum(t.correction_value)
+        from (select budget_id, correction_value from corrections where correction_type = 'A'
+              union all
+              select budget_id, correction_value from {schema}.corrections_archive where correction_type = 'A') t
+        left join budgets m on m.budget_id = t.budget_id
+        group by t.budget_id
+        having sum(t.correction_value) != 0'''),
+    ("totals",
+     '''select d.budget_id, m.year, m.month, d.account_id, a.account_name, d.expected, d.found
+        from (select c.budget_id, c.account_id, c.total as expected, t.total_correction as found
+              from (select budget_id, account_id, sum(correction_value) as total
+                    from corrections group by budget_id, account_id) c
+              left join envelope_totals t on t.budget_id = c.budget_id and t.account_id = c.account_id
+              where t.total_correction is null or t.total_correction != c.total
+              union all
+              select t.budget_id, t.account_id, 0, t.total_correction
+              from envelope_totals t
+              where t.total_correction != 0
+              and not exists (select 1 from corrections c
+                              where c.budget_id = t.budget_id and c.account_id = t.account_id)) d
+        left join budgets m on m.budget_id = d.budget_id
+        left join accounts a on a.account_id = d.account_id'''),
+    ]
+
+
+class report_writer:
+    '''Streams report rows to an open file, one budget month (section) at a time'''
+    extensions = ()
+
+    def __init__(self, out, title, columns, color):
+        self.out = out
+        self.title = title
+        self.columns = columns
+        self.color = color
+
+    def amounts(self, values):
+        t = lambda x: " " if x == 0 else db_out(x)
+        return(list(values[:2]) + [t(values[2]), db_out(values[3]), db_out(values[4])])
+
+    def begin(self):
+        pass
+
+    def section(self, year, month):
+        pass
+
+    def row(self, year, month, values):
+        pass
+
+    def end(self):
+        pass
+
+
+class html_report(report_writer):
+    extensions = (".html", ".htm")
+
+    def begin(self):
+        self.out.write('''<!DOCTYPE html><html>
+                                <head>
+                                <style>table, th, td{border:1px solid black; border-collapse: collapse};</style></head>
+                                <body>
+                                ''')
+        self.open = False
+
+    def section(self, year, month):
+        if self.open:
+            self.out.write("</table>\n")
+        self.out.write("<h3>{} {}-{:02d}</h3>\n<table style='width 100%'>\n<tr>".format(self.title, year, month))
+        self.out.write("".join("<th>{}</th>".format(c) for c in self.columns) + "</tr>\n")
+        self.open = True
+
+    def row(self, year, month, values):
+        values = self.amounts(values)
+        cells = "".join("<td>{}</td>".format(html_escape.escape(str(v))) for v in values[:-1])
+        self.out.write("<tr>{}{}</tr>\n".format(cells, self.color(values[-1], html=True)))
+
+    def end(self):
+        if self.open:
+            self.out.write("</table>")
+        self.out.write("</body></html>")
+
+
+class csv_report(report_writer):
+    extensions = (".csv",)
+
+    def begin(self):
+        import csv
+        self.writer = csv.writer(self.out)
+        self.writer.writerow(["Year", "Month"] + self.columns)
+
+    def row(self, year, month, values):
+        self.writer.writerow([year, month] + [v.strip() if isinstance(v, str) else v for v in self.amounts(values)])
+
+
+class json_report(report_writer):
+    extensions = (".jsonl", ".json")
+
+    def begin(self):
+        self.keys = ["year", "month"] + [c.lower() for c in self.columns]
+
+    def row(self, year, month, values):
+        values = [year, month] + list(values[:2]) + [float(db_out(v)) for v in values[2:]]
+        self.out.write(json.dumps(dict(zip(self.keys, values))) + "\n")
+
+
+class plain_report(report_writer):
+    '''Aligned text without colors or third-party modules, for scripts'''
+    extensions = (".txt",)
+
+    def begin(self):
+        self.rows = []
+
+    def section(self, year, month):
+        self.flush()
+        self.rows = [["{}-{:02d}".format(year, month)], self.columns]
+
+    def row(self, year, month, values):
+        self.rows.append([str(v) for v in self.amounts(values)])
+
+    def flush(self):
+        if len(self.rows) < 2:
+            return
+        title, rows = self.rows[0], self.rows[1:]
+        widths = [max(len(r[i]) for r in rows) for i in range(len(self.columns))]
+        self.out.write(title[0] + "\n")
+        for r in rows:
+            # Amounts are right aligned
+            cells = [r[i].ljust(widths[i]) if i < 2 else r[i].rjust(widths[i]) for i in range(len(r))]
+            self.out.write("  ".join(cells).rstrip() + "\n")
+        self.rows = []
+
+    def end(self):
+        self.flush()
+
+
+class markdown_report(report_writer):
+    extensions = (".md",)
+
+    def section(self, year, month):
+        self.out.write("\n## {} {}-{:02d}\n\n".format(self.title, year, month))
+        self.out.write("| " + " | ".join(self.columns) + " |\n")
+        self.out.write("|" + "---|"*len(self.columns) + "\n")
+
+    def row(self, year, month, values):
+        cells = [str(v).replace("|", "\\|") for v in self.amounts(values)]
+        self.out.write("| " + " | ".join(cells) + " |\n")
+
+
+report_formats = {"html": html_report,
+                  "plain": plain_report,
+                  "csv": csv_report,
+                  "jsonl": json_report,
+                  "md": markdown_report}
+
+
 class budget:
-    def __init__(self, db, beanfile, tempfile, month=None, year=None,init=False):
+    def __init__(self, db, beanfile, tempfile, month=None, year=None,init=False,backend=None,cache=None,cache_size=64,lazy=False,sync_max_age=0,database_only=False):
         self.beanfile = beanfile
         today = datetime.date.today()
         if month == None:
@@ -89,53 +645,635 @@ class budget:
         self.connect(db)
         self.bq = "bean-query"
         self.tempfile = tempfile
+        if backend == None:
+            if importlib.util.find_spec("beancount") != None:
+                backend = "beancount"
+            else:
+                backend = "bean-query"
+        self.backend = backend
+        self.ledger = None
+        self.ledger_synced = False
+        self.filters = None
+        self.sync_max_age = sync_max_age
+        if cache:
+            self.cache = ledger_cache(cache, beanfile, cache_size)
+        else:
+            self.cache = None
+        if database_only:
+            # Commands over every budget, such as audit, need no budget month
+            return
         if init:
             self.open_budget()
         else:
             self.get_budget_id()
+            if lazy:
+                self.check_budget_status()
+                self.get_income()
+            else:
+                self.sync()
+
+    def sync(self):
+        '''Refresh this budget's income, spending and accounts from the ledger'''
+        self.sync_ledger()
+        with self.transaction():
             self.check_budget_status()
             self.get_bean_income()
             self.load_income()
             self.get_income()
             self.get_bean_accounts()
+            # New accounts need their budget_base rows before spending is written
+            self.reconcile_accounts()
             self.load_accounts()
-            self.insert_accounts()
-            self.update_missing()
+            state = {"fingerprint": self.ledger_fingerprint(), "time": time.time()}
+            sql = '''insert or replace into sync_state values (?, ?)'''
+            self.write_sql(sql, ["budget:{}".format(self.budget_id), json.dumps(state)])
+
+    def ledger_fingerprint(self):
+        '''Identify the ledger contents and filters that ledger_monthly was last built from'''
+        digest = hashlib.sha256()
+        for row in self.read_sql('''select path, size, digest from ledger_files order by path''', []):
+            digest.update(json.dumps(row).encode('utf-8'))
+        row = self.read_sql('''select value from sync_state where key = ?''', ['filter_signature'], single=True)
+        if row != None:
+            digest.update(row[0].encode('utf-8'))
+        return(digest.hexdigest())
+
+    def is_stale(self):
+        '''Check whether this budget needs syncing with the ledger'''
+        sql = '''select value from sync_state where key = ?'''
+        row = self.read_sql(sql, ["budget:{}".format(self.budget_id)], single=True)
+        if row == None:
+            return(True)
+        state = json.loads(row[0])
+        if self.sync_max_age and time.time() - state["time"] < self.sync_max_age:
+            return(False)
+        if self.ledger_changes() != "unchanged":
+            return(True)
+        self.filter_plan()
+        row = self.read_sql(sql, ['filter_signature'], single=True)
+        if row == None or row[0] != self.filters[0]:
+            return(True)
+        return(state["fingerprint"] != self.ledger_fingerprint())
+
+    def ensure_synced(self, force=None):
+        '''Sync a lazily built budget with the ledger when needed
+
+        force=True always syncs and force=False never does. Otherwise only
+        stale budgets are synced, and closed budgets never are.'''
+        if force == False:
+            return
+        if force == None and (self.budget_closed or not self.is_stale()):
+            return
+        self.sync()
 
 
     def connect(self,db):
         '''Open a connection to the beanvelope (sqlite) database'''
+        # sqlite3 would create a missing file, which migrate then rejects
+        if not os.path.exists(db):
+            print("No beanvelope database at {}".format(db))
+            exit(25)
         self.dbobject = sqlite3.connect(db)
         self.curs = self.dbobject.cursor()
+        # WAL lets readers carry on while a sync or rollover is writing, and
+        # synchronous=normal is still crash-safe in WAL mode
+        self.curs.execute('pragma journal_mode = wal')
+        self.curs.execute('pragma synchronous = normal')
+        self.curs.execute('pragma busy_timeout = 5000')
+        self.tx_depth = 0
+        self.tx_failed = False
+        self.migrate()
+
+    def migrate(self):
+        '''Upgrade the database schema in place to the latest migration'''
+        # Migrations build on beanvelope.sql; never apply them to anything else
+        if self.curs.execute('''select count(*) from sqlite_master
+                                where type = 'table' and name = 'budgets' ''').fetchone()[0] == 0:
+            self.dbobject.close()
+            print("Not a beanvelope database (create it from beanvelope.sql first)")
+            exit(25)
+        version = self.curs.execute('pragma user_version').fetchone()[0]
+        for number, script in enumerate(migrations[version:], start=version + 1):
+            # Each migration and its version bump commit together
+            try:
+                self.dbobject.executescript('begin immediate;\n' + script +
+                                            '\npragma user_version = {};\ncommit;'.format(number))
+            except sqlite3.Error:
+                if self.dbobject.in_transaction:
+                    self.dbobject.rollback()
+                print("Schema migration {} failed".format(number))
+                raise
+
+    def explain_queries(self):
+        '''Print the EXPLAIN QUERY PLAN of the core budget queries'''
+        queries = [
+            ("envelope_balance",
+             '''select a.account_id, b.base_value + c.total_correction - b.spending
+                from accounts a, budget_base b, envelope_totals c
+                where a.account_id = b.account_id
+                and b.account_id = c.account_id
+                and b.budget_id = c.budget_id
+                and b.budget_id = ?''', [self.budget_id]),
+            ("base_planner",
+             '''select a.account_id, a.account_name, b.target, c.carried, b.base_value
+                from accounts a, budget_base b,
+                     (select account_id, sum(correction_value) as carried
+                      from corrections
+                      where budget_id = ? and correction_type = ?
+                      group by account_id) c
+                where a.account_id = b.account_id
+                and b.account_id = c.account_id
+                and b.budget_id = ?''', [self.budget_id, 'C', self.budget_id]),
+            ("reconcile_accounts",
+             '''select b.budget_id, a.account_id
+                from budgets b, accounts a
+                where b.closed = 0 and a.closed = 0
+                and not exists (select 1 from budget_base bb
+                                where bb.budget_id = b.budget_id
+                                and bb.account_id = a.account_id)''', []),
+            ("allocation_balance",
+             '''select sum(base_value) from budget_base where budget_id = ?''', [self.budget_id]),
+            ]
+        for name, sql, params in queries:
+            print(name)
+            for row in self.curs.execute('explain query plan ' + sql, params):
+                print("   ", row[3])
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Group every write in the block into one atomic commit
+
+        Blocks may nest; only the outermost one commits. The unit of work is
+        rolled back if the block raises or any write_sql call in it fails.'''
+        if self.tx_depth == 0:
+            if self.dbobject.in_transaction:
+                self.dbobject.commit()
+            self.curs.execute('begin immediate')
+            self.tx_failed = False
+        self.tx_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.tx_depth -= 1
+            if self.tx_depth == 0:
+                self.dbobject.rollback()
+            raise
+        self.tx_depth -= 1
+        if self.tx_depth == 0:
+            if self.tx_failed:
+                self.dbobject.rollback()
+            else:
+                self.dbobject.commit()
+
+    @contextlib.contextmanager
+    def attached_archive(self, archive):
+        '''Attach the archive database, if one is given, for the block
+
+        Yields the schema holding corrections_archive: "archive", or "main"
+        when there is no archive. The archive is detached however the block
+        exits.'''
+        if not archive:
+            yield "main"
+            return
+        self.write_sql('''attach database ? as archive''', [archive])
+        try:
+            self.dbobject.executescript(archive_schema.format(schema="archive"))
+            yield "archive"
+        finally:
+            self.write_sql('''detach database archive''', [])
 
     def close(self):
         self.dbobject.close()
+        if self.cache != None:
+            self.cache.close()
 
     def write_temp(self, contents):
+        '''Dump raw query output to the configured tempfile for debugging'''
         with open(self.tempfile, 'w') as target:
             target.write(contents)
 
-    def read_temp(self):
-        with open(self.tempfile, 'r') as target:
-            a = target.readlines()
-        return(a[2:])
+    async def beancount_rows(self, stream, raw, header=2):
+        '''Yield result rows from bean-query output as they arrive, skipping the header'''
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            line = line.decode('utf-8')
+            if self.tempfile:
+                raw.append(line)
+            if header > 0:
+                header -= 1
+            elif line.strip():
+                yield line
+
+    async def gather_beancount(self, queries):
+        import asyncio
+        limit = asyncio.Semaphore(os.cpu_count() or 1)
+        async def run(query, parse, raw):
+            async with limit:
+                proc = await asyncio.create_subprocess_exec(self.bq, self.beanfile, query, stdout=asyncio.subprocess.PIPE)
+                # PRINT writes directives without a column header
+                header = 0 if query.lower().startswith("print") else 2
+                records = [parse(row) async for row in self.beancount_rows(proc.stdout, raw, header)]
+                await proc.wait()
+            if proc.returncode != 0:
+                import subprocess
+                raise subprocess.CalledProcessError(proc.returncode, [self.bq, self.beanfile, query])
+            return(records)
+        return(await asyncio.gather(*[run(query, parse, raw) for (query, parse), raw in zip(queries, self.raw_output)]))
+
+    def run_beancount(self, queries):
+        '''Run independent bean-query invocations concurrently
+
+        queries is a list of (query, parse) pairs; the result rows of each are
+        passed through parse straight from the pipe.'''
+        import asyncio
+        self.raw_output = [[] for query in queries]
+        results = asyncio.run(self.gather_beancount(queries))
+        if self.tempfile:
+            self.write_temp(''.join(''.join(raw) for raw in self.raw_output))
+        return(results)
+
+    def load_ledger(self):
+        '''Parse the beancount file once and keep the entries for later queries'''
+        if self.ledger == None:
+            load_beancount()
+            entries, errors, options = bean_loader.load_file(self.beanfile)
+            # The ledger is still used, so report what beancount rejected
+            if len(errors) > 0:
+                bean_printer.print_errors(errors, file=sys.stderr)
+                print("{} errors in {}".format(len(errors), self.beanfile), file=sys.stderr)
+            self.ledger = entries
+            self.ledger_options = options
+        return(self.ledger)
+
+    def ledger_transactions(self, entries):
+        for entry in entries:
+            if isinstance(entry, bean_data.Transaction):
+                yield entry
+
+    def aggregate_transactions(self, transactions):
+        '''Sum expense/liability ('E') and income ('I') postings by year, month and account
+
+        Expense/liability postings go through the filter_mods plan on the way:
+        the first matching rule for the account excludes the posting or
+        counts it towards another envelope.'''
+        plan = self.filter_plan()
+        totals = {}
+        currencies = {}
+        for txn in transactions:
+            others = [p.account for p in txn.postings]
+            for post in txn.postings:
+                keys = []
+                if 'Expenses' in post.account or ('Liabilities' in post.account and 'Expenses:Interest' not in others):
+                    account = post.account
+                    for action, target, conditions in plan.get(account, []):
+                        if filter_matches(conditions, txn):
+                            account = target
+                            break
+                    if account != None:
+                        keys.append(('E', txn.date.year, txn.date.month, account))
+                if 'Income' in post.account and 'Exclude' not in txn.tags:
+                    keys.append(('I', txn.date.year, txn.date.month, 'Income'))
+                for key in keys:
+                    totals[key] = totals.get(key, Decimal(0)) + post.units.number
+                    currencies[key] = post.units.currency
+        positions = []
+        for key in sorted(totals):
+            value = str(totals[key].quantize(Decimal('0.01')))
+            positions.append(position(account=key[3], value=value, currency=currencies[key], year=key[1], month=key[2], kind=key[0]))
+        return(positions)
+
+    def filter_plan(self):
+        '''Return the compiled filter_mods plan as {account name: [rule, ...]}
+
+        The plan is recompiled only when the contents of filter_mods change.'''
+        sql = '''select a.account_name, f.filter_text
+                 from filter_mods f join accounts a on a.account_id = f.account_id
+                 order by a.account_name, f.rowid'''
+        rows = self.read_sql(sql, [])
+        signature = hashlib.sha256(json.dumps(rows).encode('utf-8')).hexdigest()
+        if self.filters != None and self.filters[0] == signature:
+            return(self.filters[1])
+        plan = {}
+        for account, text in rows:
+            rule = compile_filter(text)
+            if rule == None:
+                print("Invalid filter for {}: {}".format(account, text))
+                exit(18)
+            plan.setdefault(account, []).append(rule)
+        self.filters = (signature, plan)
+        return(plan)
+
+    def filter_query(self):
+        '''Compile the filter plan for bean-query
+
+        Exclusions become extra WHERE terms; unconditional reassignments are
+        returned as {account: target} and applied to the grouped results.
+        Conditional reassignments need the beancount backend.'''
+        where = ""
+        reassign = {}
+        for account, rules in self.filter_plan().items():
+            for action, target, conditions in rules:
+                if action == 'exclude':
+                    where += " and not (account = '{}' and {})".format(account, filter_condition_sql(conditions))
+                elif len(conditions) == 0:
+                    reassign.setdefault(account, target)
+                else:
+                    print("Ignoring conditional reassign of {} on the bean-query backend".format(account))
+        return(where, reassign)
+
+    def reassign_positions(self, positions, reassign):
+        totals = {}
+        currencies = {}
+        for entry in positions:
+            key = (entry.year, entry.month, reassign.get(entry.account, entry.account))
+            totals[key] = totals.get(key, Decimal(0)) + Decimal(entry.value)
+            currencies[key] = currencies.get(key) or entry.currency
+        results = []
+        for key in sorted(totals):
+            value = str(totals[key].quantize(Decimal('0.01')))
+            results.append(position(account=key[2], value=value, currency=currencies[key], year=key[0], month=key[1], kind='E'))
+        return(results)
 
-    def run_beancount(self, query):
-        output = subprocess.check_output([self.bq, self.beanfile, query])
-        results = output.decode('utf-8')
-        self.write_temp(results)
+    def open_close(self, entries):
+        '''Yield (date, "open" or "close", account) for the Open/Close directives in entries'''
+        for entry in entries:
+            if isinstance(entry, bean_data.Open):
+                yield (str(entry.date), "open", entry.account)
+            elif isinstance(entry, bean_data.Close):
+                yield (str(entry.date), "close", entry.account)
+
+    def ledger_directives(self, directives):
+        '''Collect [account, open date, close date] for every expense and liability account
+
+        directives are (date, "open" or "close", account) triples. Both
+        backends read them from the Open/Close directives, so accounts that
+        never had a posting still get an envelope.'''
+        dates = {}
+        for date, kind, account in directives:
+            if 'Expenses' in account or 'Liabilities' in account:
+                dates.setdefault(account, [account, None, None])[1 if kind == "open" else 2] = date
+        return([dates[account] for account in sorted(dates)])
+
+    def query_ledger(self):
+        '''Aggregate the whole ledger in a single pass
+
+        Returns the monthly aggregates as [kind, year, month, account, value,
+        currency] rows and the expense/liability account set from ledger_directives.'''
+        if self.backend == "beancount":
+            entries = self.load_ledger()
+            positions = self.aggregate_transactions(self.ledger_transactions(entries))
+            accounts = self.ledger_directives(self.open_close(entries))
+        else:
+            where, reassign = self.filter_query()
+            queries = [("select year, month, account, sum(position) where (account ~ 'Expenses' or (account ~ 'Liabilities' and not 'Expenses:Interest' in other_accounts)){} group by year, month, account order by year, month, account".format(where),
+                        lambda row: position(row, kind='E', grouped=True)),
+                       ("select year, month, 'Income', sum(position) where account ~ 'Income' and not 'Exclude' in tags group by year, month, 'Income' order by year, month",
+                        lambda row: position(row, kind='I', grouped=True)),
+                       # Metadata lines under a directive are indented
+                       ("print from type = 'open' or type = 'close'",
+                        lambda row: [] if row[:1].isspace() else row.split()[:3])]
+            expenses, income, directives = self.run_beancount(queries)
+            positions = self.reassign_positions(expenses, reassign) + income
+            accounts = self.ledger_directives(d for d in directives if len(d) == 3)
+        monthly = [[p.kind, p.year, p.month, p.account, p.value, p.currency] for p in positions]
+        return({"monthly": monthly, "accounts": accounts})
+
+    def ledger_files(self):
+        '''List the source files that make up the ledger'''
+        if self.ledger != None:
+            return(self.ledger_options['include'])
+        return(ledger_includes(self.beanfile))
+
+    def cached_query(self, key, compute):
+        '''Return the result for key from the ledger cache, computing and storing it on a miss'''
+        if self.cache != None:
+            result = self.cache.get(key)
+            if result != None:
+                return(result)
+        result = compute()
+        if self.cache != None:
+            if self.cache.fingerprint == None:
+                self.cache.record_files(self.ledger_files())
+            self.cache.put(key, result)
+        return(result)
+
+    def ledger_file_marks(self, paths):
+        '''Return the high-water mark (path, size, mtime and content hash) of every ledger file'''
+        rows = []
+        for path in paths:
+            stat = os.stat(path)
+            rows.append((path, stat.st_size, stat.st_mtime_ns, file_digest(path)))
+        return(rows)
+
+    def record_ledger_files(self, rows):
+        '''Store the high-water mark from ledger_file_marks
+
+        The root beanfile is stored with it, since a database pointed at
+        another ledger must be rebuilt rather than compared file by file.'''
+        self.write_sql('''delete from ledger_files''', [])
+        self.write_sql('''insert into ledger_files values (?,?,?,?)''', rows, single=False)
+        sql = '''insert or replace into sync_state values ('beanfile', ?)'''
+        self.write_sql(sql, [os.path.abspath(self.beanfile)])
+
+    def ledger_changes(self):
+        '''Compare the ledger files against the high-water mark
+
+        Returns "unchanged", a list of (path, offset, lines before offset) for
+        files that were only appended to, or "rebuild" when earlier history
+        changed or the high-water mark belongs to another beanfile.'''
+        sql = '''select value from sync_state where key = ?'''
+        root = self.read_sql(sql, ['beanfile'], single=True)
+        if root == None or root == "sql_failure" or root[0] != os.path.abspath(self.beanfile):
+            return("rebuild")
+        rows = self.read_sql('''select path, size, mtime, digest from ledger_files''', [])
+        if rows == "sql_failure" or len(rows) == 0:
+            return("rebuild")
+        unchanged = True
+        appended = []
+        for path, size, mtime, digest in rows:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return("rebuild")
+            if stat.st_size == size and stat.st_mtime_ns == mtime:
+                continue
+            unchanged = False
+            if stat.st_size < size:
+                return("rebuild")
+            with open(path, 'rb') as source:
+                prefix = source.read(size)
+            if hashlib.sha256(prefix).hexdigest() != digest:
+                return("rebuild")
+            if stat.st_size > size:
+                if size > 0 and not prefix.endswith(b'\n'):
+                    return("rebuild")
+                appended.append((path, size, prefix.count(b'\n')))
+        if unchanged:
+            return("unchanged")
+        return(appended)
+
+    def parse_appended(self, appended):
+        '''Parse only the appended tails of the ledger files, or None if that is not possible'''
+        if len(appended) == 0:
+            return([])
+        if self.backend != "beancount":
+            return(None)
+        load_beancount()
+        directives = []
+        for path, offset, lines in appended:
+            with open(path, 'rb') as source:
+                source.seek(offset)
+                tail = source.read().decode('utf-8')
+            # New includes, options or plugins change the meaning of the whole ledger
+            if re.search(r'^(include|option|plugin)\s', tail, re.M):
+                return(None)
+            entries, errors, options = bean_parser.parse_string(tail, report_filename=path, report_firstline=lines + 1)
+            if len(errors) > 0:
+                return(None)
+            entries, errors = bean_booking.book(entries, options)
+            if len(errors) > 0:
+                return(None)
+            directives.extend(entries)
+        # Tails are not validated, so leave postings to closed accounts to the
+        # full load, which reports them
+        closed = self.read_sql('''select account_name, close_date from ledger_accounts
+                                  where close_date is not null''', [])
+        if closed == "sql_failure":
+            return(None)
+        closed = dict(closed)
+        for entry in directives:
+            if isinstance(entry, bean_data.Close):
+                closed[entry.account] = str(entry.date)
+        for entry in self.ledger_transactions(directives):
+            if any(str(entry.date) > closed.get(p.account, "9999") for p in entry.postings):
+                return(None)
+        return(directives)
+
+    def sync_ledger(self):
+        '''Bring the ledger_monthly aggregates up to date with the ledger
+
+        Only transactions appended since the last sync are folded in; the
+        aggregates are rebuilt from scratch when earlier history changed.
+        The ledger is read before the write transaction is opened, so other
+        writers are not locked out while it is parsed, and the work is done
+        again if another process synced the ledger in the meantime.'''
+        while not self.ledger_synced:
+            mark = self.ledger_state()
+            self.filter_plan()
+            sql = '''select value from sync_state where key = ?'''
+            stored = self.read_sql(sql, ['filter_signature'], single=True)
+            if stored == None or stored[0] != self.filters[0]:
+                # Aggregates were built with different filters
+                changes = "rebuild"
+            else:
+                changes = self.ledger_changes()
+            if changes == "unchanged":
+                self.ledger_synced = True
+                return
+            entries = None
+            if changes != "rebuild":
+                entries = self.parse_appended(changes)
+            if entries == None:
+                ledger = self.cached_query("ledger " + self.filters[0], self.query_ledger)
+                monthly = ledger["monthly"]
+                accounts = ledger["accounts"]
+            else:
+                positions = self.aggregate_transactions(self.ledger_transactions(entries))
+                monthly = [[p.kind, p.year, p.month, p.account, p.value, p.currency] for p in positions]
+                accounts = self.ledger_directives(self.open_close(entries))
+            rows = [(r[0], r[1], r[2], r[3], db_in(r[4]), r[5]) for r in monthly]
+            files = self.ledger_file_marks(self.ledger_files())
+            with self.transaction():
+                if self.ledger_state() != mark:
+                    continue
+                if entries == None:
+                    self.write_sql('''delete from ledger_monthly''', [])
+                    self.write_sql('''delete from ledger_accounts''', [])
+                sql = '''insert into ledger_monthly values (?,?,?,?,?,?)
+                         on conflict (kind, year, month, account_name)
+                         do update set value = value + excluded.value'''
+                self.write_sql(sql, rows, single=False)
+                sql = '''insert into ledger_accounts values (?,?,?)
+                         on conflict (account_name)
+                         do update set open_date = coalesce(excluded.open_date, open_date),
+                                       close_date = coalesce(excluded.close_date, close_date)'''
+                self.write_sql(sql, accounts, single=False)
+                sql = '''insert or replace into sync_state values ('filter_signature', ?)'''
+                self.write_sql(sql, [self.filters[0]])
+                self.record_ledger_files(files)
+                self.ledger_synced = True
+
+    def ledger_state(self):
+        '''Return the high-water mark and filter signature the aggregates were last built from'''
+        files = self.read_sql('''select path, size, mtime, digest from ledger_files order by path''', [])
+        sql = '''select key, value from sync_state where key in ('beanfile', 'filter_signature') order by key'''
+        return((files, self.read_sql(sql, [])))
+
+    def monthly_positions(self, kind, month, year):
+        sql = '''select account_name, value, currency from ledger_monthly
+                 where kind = ? and year = ? and month = ?
+                 order by account_name'''
+        results = self.read_sql(sql, [kind, year, month])
+        positions = []
+        for account, value, currency in results:
+            positions.append(position(account=account, value=db_out(value), currency=currency, year=year, month=month))
+        return(positions)
+
+    def sync_range(self, start=None, end=None):
+        '''Update income and spending for every open budget from start to end in one transaction
+
+        start and end are (year, month) tuples and default to the first and
+        last budgets. The ledger is aggregated once for all months. Closed
+        budgets are left alone, since their balances have already been
+        carried into the following month. Returns the number of budgets updated.'''
+        self.sync_ledger()
+        if start == None:
+            start = (0, 1)
+        if end == None:
+            end = (9999, 12)
+        bounds = [start[0]*12 + start[1], end[0]*12 + end[1]]
+        statements = [
+            ('''insert into income (budget_id, income)
+                select b.budget_id, -coalesce(
+                    (select m.value from ledger_monthly m
+                     where m.kind = 'I'
+                     and m.year*12 + m.month = b.year*12 + b.month - 1), 0)
+                from budgets b
+                where b.year*12 + b.month between ? and ? and b.closed = 0
+                on conflict (budget_id) do update set income = excluded.income''', bounds),
+            ('''update budget_base
+                set spending = coalesce(
+                    (select m.value
+                     from ledger_monthly m, accounts a, budgets b
+                     where a.account_id = budget_base.account_id
+                     and b.budget_id = budget_base.budget_id
+                     and m.kind = 'E'
+                     and m.year = b.year
+                     and m.month = b.month
+                     and m.account_name = a.account_name), 0)
+                where budget_id in
+                    (select budget_id from budgets
+                     where year*12 + month between ? and ? and closed = 0)''', bounds),
+            ]
+        with self.transaction():
+            for sql, params in statements:
+                self.write_sql(sql, params)
+        if self.tx_failed:
+            return("sql_failure")
+        sql = '''select count(*) from budgets where year*12 + month between ? and ? and closed = 0'''
+        return(self.read_sql(sql, bounds, single=True)[0])
 
-    
     def get_bean_accounts(self):
-        '''Create a tempfile containing the current list of accounts from beancount'''
-        #query = "balances from month = {} and year = {} where account ~ 'Expenses' or (account ~ 'Liabilities' and not 'Expenses:Interest' in other_accounts) order by account".format(self.month, self.year)
-        query = "select account,sum(position) from month = {} and year = {} where account ~ 'Expenses' or (account ~ 'Liabilities' and not 'Expenses:Interest' in other_accounts) group by account order by account".format(self.month, self.year)
-        self.run_beancount(query)
+        '''Collect the current month's expense and liability positions from beancount'''
+        self.sync_ledger()
+        self.bean_accounts = self.monthly_positions('E', self.month, self.year)
 
     def get_bean_income(self):
-        '''Create a tempfile containing the available income from beancount'''
-        query = "select 'Income',sum(position) from month = {} and year = {}  where account ~ 'Income' and not 'Exclude' in tags group by 'Income'".format(self.last_month, self.last_year)
-        self.run_beancount(query)
+        '''Collect the available income (last month's earnings) from beancount'''
+        self.sync_ledger()
+        self.bean_income = self.monthly_positions('I', self.last_month, self.last_year)
 
     def write_sql(self, sql, params, get_id=False,single=True,debug=False):
         if debug:
@@ -152,9 +1290,12 @@ class budget:
             except sqlite3.IntegrityError:
                 return("constraint_violation")
             except:
+                if self.tx_depth > 0:
+                    self.tx_failed = True
                 return("sql_failure")
             else:
-                self.dbobject.commit()
+                if self.tx_depth == 0:
+                    self.dbobject.commit()
                 if get_id == True:
                     return(self.curs.lastrowid)
                 else:
@@ -182,54 +1323,66 @@ class budget:
 
 
 
-    def insert_accounts(self):
-        '''Insert new accounts into the database, as needed'''
-        accounts = self.read_temp()
-        for row in accounts:
-            entry = position(row)
-            sql = '''insert into accounts (account_name) values (?)'''
-            results = self.write_sql(sql, [str(entry.get_account())], get_id=True)
-            if results == "constraint_violation":
-                pass
-            elif results == "sql_failure":
-                exit(1)
-            else:
-                sql = '''insert into corrections values (?,?,?,?)'''
-                corr = self.write_sql(sql, [self.budget_id,results,'C',0])
-
-    def update_missing(self):
-        '''Update a budget to include new expense accounts'''
-        accounts = self.read_temp()
-        # Generate temp table of this month's accounts
-        sql = '''create temporary table budget_temp as
-                    select budget_id, account_id
-                    from budget_base
-                    where budget_id = ?'''
-        b_tmp = self.write_sql(sql, [self.budget_id])
-
-        # Look for account
-        sql = '''create temporary table accounts_temp as 
-                    select a.account_id, b.budget_id 
-                    from accounts a left outer join budget_temp b 
-                    on a.account_id = b.account_id
-                    where a.closed = 0'''
-        tmp_write = self.write_sql(sql, [])
-        sql = '''select account_id from accounts_temp
-                 where budget_id is null'''
-        tmp_read = self.read_sql(sql, [], single=False)
-        val_list = []
-        for i in tmp_read:
-            val_list.append((self.budget_id, i[0]))
-        #print(val_list)
-        sql = '''insert into budget_base values (?,?,0,0,0)'''
-        results = self.write_sql(sql, val_list, single = False)
-        sql = '''insert into corrections values (?,?,'C',0)'''
-        results = self.write_sql(sql, val_list, single = False)
+    def reconcile_accounts(self):
+        '''Bring the accounts table and every open budget in line with the ledger's account set
+
+        The ledger's accounts are its expense/liability Open/Close directives
+        plus any account with spending. In one transaction, new accounts are
+        inserted, accounts closed before the earliest open budget are marked
+        closed (and reopened if the Close goes away), and open budgets get
+        the budget_base and 'C' rows they are missing.'''
+        sql = '''select min(year*12 + month) from budgets where closed = 0'''
+        first = self.read_sql(sql, [], single=True)[0]
+        if first == None:
+            first = self.year*12 + self.month
+        cutoff = "{:04d}-{:02d}-01".format((first - 1)//12, (first - 1)%12 + 1)
+        statements = [
+            ('''create temporary table if not exists ledger_account_set
+                    (account_name text primary key, closed boolean)''', []),
+            ('''delete from ledger_account_set''', []),
+            ('''insert into ledger_account_set
+                select account_name, coalesce(close_date < ?, 0) from ledger_accounts
+                union
+                select distinct account_name, 0 from ledger_monthly
+                where kind = 'E'
+                and account_name not in (select account_name from ledger_accounts)''', [cutoff]),
+            ('''insert into accounts (account_name)
+                select account_name from ledger_account_set
+                where closed = 0
+                and account_name not in (select account_name from accounts)''', []),
+            ('''update accounts set closed =
+                    (select l.closed from ledger_account_set l
+                     where l.account_name = accounts.account_name)
+                where account_name in (select account_name from ledger_account_set)''', []),
+            ('''insert into corrections
+                select b.budget_id, a.account_id, 'C', 0
+                from budgets b, accounts a
+                where b.closed = 0 and a.closed = 0
+                and not exists (select 1 from budget_base bb
+                                where bb.budget_id = b.budget_id
+                                and bb.account_id = a.account_id)''', []),
+            ('''insert into budget_base
+                select b.budget_id, a.account_id, 0, 0, 0
+                from budgets b, accounts a
+                where b.closed = 0 and a.closed = 0
+                and not exists (select 1 from budget_base bb
+                                where bb.budget_id = b.budget_id
+                                and bb.account_id = a.account_id)''', []),
+            ]
+        self.sync_ledger()
+        with self.transaction():
+            for sql, params in statements:
+                self.write_sql(sql, params)
+        if self.tx_failed:
+            print("Failed to reconcile accounts")
+            exit(1)
 
     def load_income(self):
-        income = self.read_temp()
-        entry = position(income[0])
-        
+        if len(self.bean_income) == 0:
+            entry = position(account='Income', value='0', currency=None)
+        else:
+            entry = self.bean_income[0]
+
         sql = '''insert into income values (?, ?)'''
         #results = self.write_sql(sql, [self.budget_id, str(-100*float(entry.get_value()))])
         results = self.write_sql(sql, [self.budget_id, -1*db_in(entry.get_value())])
@@ -239,12 +1392,13 @@ class budget:
 
     def load_accounts(self):
         if self.budget_active:
-            accounts = self.read_temp()
             load_list = []
-            for row in accounts:
-                entry = position(row)
+            for entry in self.bean_accounts:
                 vals = (db_in(entry.get_value()), entry.get_account(),self.budget_id)
                 load_list.append(vals)
+            # Accounts with no postings left (e.g. after a filter change) spent nothing
+            sql = '''update budget_base set spending = 0 where budget_id = ?'''
+            self.write_sql(sql, [self.budget_id])
             sql = '''update budget_base 
                      set spending = ? 
                      where account_id = (select account_id from accounts where account_name = ?)
@@ -259,24 +1413,26 @@ class budget:
 
     def open_budget(self):
         '''Create a new entry in the budgets table'''
-        sql = '''insert into budgets (year,month) values (?, ?)'''
-        budget_id = self.write_sql(sql,[str(self.year), str(self.month)],get_id=True)
-        if budget_id == "constraint_violation":
-            print("Budget already exists")
-            return(3)
-        elif budget_id == "sql_failure":
-            print("Error encountered")
-            exit(2)
-        elif budget_id > 0:
-            self.budget_id = budget_id
-            self.check_budget_status()
-            self.get_bean_accounts()
-            self.load_accounts()
-            self.insert_accounts()
-            self.create_budget_envelopes()
+        self.sync_ledger()
+        with self.transaction():
+            sql = '''insert into budgets (year,month) values (?, ?)'''
+            budget_id = self.write_sql(sql,[str(self.year), str(self.month)],get_id=True)
+            if budget_id == "constraint_violation":
+                print("Budget already exists")
+                return(3)
+            elif budget_id == "sql_failure":
+                print("Error encountered")
+                exit(2)
+            elif budget_id > 0:
+                self.budget_id = budget_id
+                self.check_budget_status()
+                self.get_bean_accounts()
+                self.load_accounts()
+                self.reconcile_accounts()
+                self.create_budget_envelopes()
 
     def create_budget_envelopes(self):
-        sql = '''insert into budget_base 
+        sql = '''insert or ignore into budget_base 
                 select ?, account_id, 0, 0, 0 from accounts'''
         results = self.write_sql(sql, [self.budget_id])
         
@@ -347,11 +1503,104 @@ class budget:
         else:
             return(9)
 
+    def apply_operations(self, lines, allow_unbalanced=False, dry_run=False):
+        '''Validate a script of envelope operations, then apply it in one transaction
+
+        Each line is "allocate ACCOUNT AMOUNT", "transfer FROM TO AMOUNT",
+        "correct ACCOUNT AMOUNT" or "target ACCOUNT AMOUNT", with accounts
+        given by id or name; blank lines and # comments are skipped. They do
+        what -e, -a, -s and -t do, under the same budget state rules, and
+        allocations must balance income as for -A unless allow_unbalanced.
+        Nothing is applied unless every line is valid.'''
+        sql = '''select a.account_id, a.account_name, b.base_value
+                 from accounts a join budget_base b on b.account_id = a.account_id
+                 where b.budget_id = ?'''
+        accounts = {}
+        base = {}
+        for account_id, name, value in self.read_sql(sql, [self.budget_id]):
+            accounts[str(account_id)] = account_id
+            accounts[name] = account_id
+            base[account_id] = value
+        arity = {"allocate": 2, "transfer": 3, "correct": 2, "target": 2}
+        amount = re.compile(r'-?[0-9]+(\.[0-9]{1,2})?$')
+        batches = dict((op, []) for op in arity)
+        errors = []
+        for number, line in enumerate(lines, 1):
+            fields = line.split("#")[0].split()
+            if len(fields) == 0:
+                continue
+            op, params = fields[0].lower(), fields[1:]
+            if op not in arity:
+                errors.append("Line {}: unknown operation {}".format(number, fields[0]))
+                continue
+            if len(params) != arity[op]:
+                errors.append("Line {}: {} takes {} arguments".format(number, op, arity[op]))
+                continue
+            ids = [accounts.get(a) for a in params[:-1]]
+            unknown = [a for a, i in zip(params, ids) if i == None]
+            if len(unknown) > 0:
+                errors.append("Line {}: unknown account {}".format(number, ", ".join(unknown)))
+            elif not amount.match(params[-1]):
+                errors.append("Line {}: invalid amount {}".format(number, params[-1]))
+            elif op == "transfer" and ids[0] == ids[1]:
+                errors.append("Line {}: transfer to the same account".format(number))
+            else:
+                batches[op].append(ids + [db_in(params[-1])])
+
+        if batches["allocate"] and self.budget_active:
+            errors.append("Budget is already active")
+        if batches["allocate"] and self.budget_closed:
+            errors.append("Budget is closed")
+        if (batches["transfer"] or batches["correct"]) and not self.budget_active:
+            errors.append("Adjustments cannot be applied to inactive budgets")
+        if batches["target"] and self.budget_closed:
+            errors.append("Targets cannot be adjusted after budget closed")
+        if batches["allocate"] and not allow_unbalanced:
+            for account_id, value in batches["allocate"]:
+                base[account_id] = value
+            balance = self.income - sum(base.values())
+            if balance != 0:
+                errors.append("Envelope allocations do not balance income: {} left".format(db_out(balance)))
+        if len(errors) > 0:
+            for error in errors:
+                print(error)
+            return(23)
+        count = sum(len(batch) for batch in batches.values())
+        if dry_run:
+            print("{} operations valid".format(count))
+            return(0)
+
+        transfers = []
+        for acc1, acc2, value in batches["transfer"]:
+            transfers += [(-value, self.budget_id, acc1), (value, self.budget_id, acc2)]
+        statements = [
+            ('''update budget_base set base_value = ? where budget_id = ? and account_id = ?''',
+             [(value, self.budget_id, acct) for acct, value in batches["allocate"]]),
+            ('''update budget_base set base_value = base_value + ? where budget_id = ? and account_id = ?''',
+             transfers),
+            ('''insert into corrections values (?, ?, 'S', ?)''',
+             [(self.budget_id, acct, value) for acct, value in batches["correct"]]),
+            ('''update budget_base set target = ? where budget_id = ? and account_id = ?''',
+             [(value, self.budget_id, acct) for acct, value in batches["target"]]),
+            ]
+        with self.transaction():
+            for sql, rows in statements:
+                if len(rows) > 0:
+                    self.write_sql(sql, rows, single=False)
+        if self.tx_failed:
+            print("Error")
+            return(1)
+        print("Applied {} operations".format(count))
+        return(0)
+
     def get_income(self):
         '''Read income from current month's budget'''
         sql = '''select income from income where budget_id = ?'''
         results = self.read_sql(sql,[self.budget_id], single=True)
-        self.income = results[0]
+        if results == None:
+            self.income = 0
+        else:
+            self.income = results[0]
 
     def allocation_balance(self):
         sql = '''select (i.income - (select sum(base_value) 
@@ -370,20 +1619,24 @@ class budget:
                     '''
         print(header.format(db_out(self.income), self.text_color(balance)))
 
+        # An envelope opened before last month was closed has a placeholder
+        # 'C' row as well as the carry, so the carries are summed
         sql = '''select a.account_id, 
                         a.account_name, 
                         b.target, 
-                        c.correction_value, 
+                        c.carried, 
                         b.base_value
-                 from accounts a, budget_base b, corrections c
+                 from accounts a, budget_base b,
+                      (select account_id, sum(correction_value) as carried
+                       from corrections
+                       where budget_id = ? and correction_type = ?
+                       group by account_id) c
                  where a.account_id = b.account_id
                  and b.account_id = c.account_id
-                 and b.budget_id = c.budget_id
                  and b.budget_id = ?
-                 and c.correction_type = ?
                  order by account_name'''
 
-        results = self.read_sql(sql, [self.budget_id, 'C'])#,debug=True)
+        results = self.read_sql(sql, [self.budget_id, 'C', self.budget_id])#,debug=True)
 
         if results != "sql_failure":
             table_values = []
@@ -395,28 +1648,190 @@ class budget:
                 
 
     def envelope_balance(self,carry=True):
-        sql = '''
-                create temporary table correction_temp 
-                as select account_id, sum(correction_value) as total_correction 
-                from corrections 
-                where budget_id = ? 
-                group by (account_id);
-                '''
-        results = self.write_sql(sql, [self.budget_id])
         sql = '''
                 select a.account_id, a.account_name, 
                     b.base_value, c.total_correction, b.spending,
                     (b.base_value + c.total_correction - b.spending) as envelope_balance,
                     b.target
-                from accounts a, budget_base b, correction_temp c
+                from accounts a, budget_base b, envelope_totals c
                 where a.account_id = b.account_id
                 and b.account_id = c.account_id
-                and budget_id = ?
+                and b.budget_id = c.budget_id
+                and b.budget_id = ?
                 order by account_name
                 '''
         results = self.read_sql(sql, [self.budget_id])
         return(results)
 
+    def rebuild_envelope_totals(self):
+        '''Recompute envelope_totals from the corrections table'''
+        with self.transaction():
+            self.write_sql('''delete from envelope_totals''', [])
+            sql = '''insert into envelope_totals
+                     select budget_id, account_id, sum(correction_value)
+                     from corrections group by budget_id, account_id'''
+            self.write_sql(sql, [])
+        if self.tx_failed:
+            return("sql_failure")
+        return(0)
+
+    def audit(self, archive=None):
+        '''Check the invariants of every budget with one query per check
+
+        Returns (check, budget_id, year, month, account_id, account_name,
+        expected, found) rows for each discrepancy. Carries and transfers of
+        compacted budgets are checked against corrections_archive, in the
+        archive database when one is given; carries into compacted budgets
+        with no archived rows cannot be checked and are skipped.'''
+        findings = []
+        with self.attached_archive(archive) as schema:
+            for check, sql in audit_checks:
+                results = self.read_sql(sql.format(schema=schema), [])
+                if results == "sql_failure":
+                    findings = "sql_failure"
+                    break
+                findings += [(check,) + tuple(row) for row in results]
+        return(findings)
+
+    def audit_repairs(self, findings):
+        '''Return SQL statements repairing what audit found, where that can be decided
+
+        Allocations and transfers that do not balance are only described.'''
+        statements = ["begin;"]
+        rebuild = False
+        errors = {}
+        for check, budget_id, year, month, account_id, account_name, expected, found in findings:
+            where = "{}-{:02d}".format(year, month) if year != None else "budget {}".format(budget_id)
+            if check == "carry":
+                errors.setdefault(account_id, {})[year*12 + month] = expected - found
+            elif check == "orphan" and account_name == None:
+                statements.append("delete from corrections where budget_id = {} and account_id = {}; -- unknown account".format(
+                    budget_id, account_id))
+            elif check == "orphan":
+                statements.append("insert into budget_base (budget_id, account_id) values ({}, {});".format(
+                    budget_id, account_id))
+            elif check == "totals":
+                rebuild = True
+            elif check == "allocation":
+                statements.append("-- {}: allocations of {} do not balance income of {}; set them with -e or apply".format(
+                    where, db_out(found), db_out(expected)))
+            elif check == "transfer":
+                statements.append("-- {}: transfers net to {}; find the unmatched correction by hand".format(
+                    where, db_out(found)))
+        if errors:
+            closed = dict((year*12 + month, closed) for year, month, closed
+                          in self.read_sql('''select year, month, closed from budgets''', []))
+        sql = '''insert into corrections select budget_id, {0}, 'C', {1} from budgets
+                 where year*12 + month between {2} and {3}
+                 and budget_id in (select budget_id from budget_base where account_id = {0});'''
+        for account_id, account_errors in sorted(errors.items()):
+            # Repairing a carry moves that month's balance, and so the carry
+            # into every following month while the months stay closed
+            runs = []
+            shift = 0
+            m = min(account_errors)
+            while m in closed:
+                shift += account_errors.get(m, 0)
+                if shift != 0 and len(runs) > 0 and runs[-1][1] == m - 1 and runs[-1][2] == shift:
+                    runs[-1][1] = m
+                elif shift != 0:
+                    runs.append([m, m, shift])
+                if not closed[m] or (shift == 0 and m >= max(account_errors)):
+                    break
+                m += 1
+            for first, last, value in runs:
+                statements.append(" ".join(sql.format(account_id, value, first, last).split())
+                                  + " -- {}-{:02d} to {}-{:02d}".format((first - 1)//12, (first - 1)%12 + 1,
+                                                                      (last - 1)//12, (last - 1)%12 + 1))
+        if rebuild:
+            # Corrections inserted above update the totals through their
+            # triggers, so the rebuild comes last
+            statements.append("delete from envelope_totals;")
+            statements.append("insert into envelope_totals select budget_id, account_id, sum(correction_value) from corrections group by budget_id, account_id;")
+        statements.append("commit;")
+        return(statements)
+
+    def audit_report(self, findings):
+        counts = dict((check, 0) for check, sql in audit_checks)
+        table_values = []
+        for check, budget_id, year, month, account_id, account_name, expected, found in findings:
+            counts[check] += 1
+            where = "{}-{:02d}".format(year, month) if year != None else "budget {}".format(budget_id)
+            table_values.append([check, where, account_name or "",
+                                 "" if expected == None else db_out(expected),
+                                 "" if found == None else db_out(found)])
+        print(tabulate([[check, count] for check, count in counts.items()], ["Check", "Discrepancies"], tablefmt="simple"))
+        if len(table_values) > 0:
+            print("")
+            print(tabulate(table_values, ["Check", "Budget", "Account", "Expected", "Found"],
+                           tablefmt="simple", disable_numparse=True))
+
+    def compact_corrections(self, year, month, archive=None, vacuum=False):
+        '''Collapse the corrections of closed budgets up to year/month into snapshots
+
+        Each account's corrections in a compacted budget are replaced by one
+        'Z' row holding their sum, so envelope balances are unchanged. The
+        detailed rows move to corrections_archive, in the attached archive
+        database when one is given. Returns the number of budgets compacted.
+
+        SQLite does not commit attached WAL databases atomically, so each
+        transaction writes to one database only: the rows are copied to the
+        archive and committed first, and deleted from corrections once the
+        archived counts match. The archive rows of a compaction interrupted
+        in between are removed on the next run.'''
+        with self.attached_archive(archive) as schema:
+            targets = '''select budget_id from budgets
+                         where closed = 1 and year*12 + month <= ?
+                         and budget_id in (select budget_id from corrections
+                                           where correction_type != 'Z')'''
+            last = int(year)*12 + int(month)
+            count = self.read_sql('''select count(*) from ({})'''.format(targets), [last], single=True)[0]
+            pending = self.read_sql('''select value from sync_state where key = ?''', ['compaction'], single=True)
+            stamp = datetime.datetime.now().isoformat(timespec='microseconds')
+            with self.transaction():
+                self.write_sql('''insert or replace into sync_state values ('compaction', ?)''', [stamp])
+            copy = [
+                ('''delete from {}.corrections_archive where archived = ?'''.format(schema),
+                 [pending and pending[0]]),
+                ('''insert into {}.corrections_archive
+                    select budget_id, account_id, correction_type, correction_value, ?
+                    from corrections
+                    where correction_type != 'Z' and budget_id in ({})'''.format(schema, targets),
+                 [stamp, last]),
+                ]
+            with self.transaction():
+                for sql, params in copy:
+                    self.write_sql(sql, params)
+            if not self.tx_failed:
+                check = '''select count(*) from ({}) t
+                         where (select count(*) from corrections c
+                                where c.budget_id = t.budget_id and c.correction_type != 'Z')
+                            != (select count(*) from {}.corrections_archive x
+                                where x.budget_id = t.budget_id and x.archived = ?)'''.format(targets, schema)
+                compact = [
+                    ('''insert into corrections
+                        select budget_id, account_id, 'Z', sum(correction_value)
+                        from corrections
+                        where correction_type != 'Z' and budget_id in ({})
+                        group by budget_id, account_id'''.format(targets), [last]),
+                    ('''delete from corrections
+                        where correction_type != 'Z'
+                        and budget_id in (select budget_id from budgets
+                                          where closed = 1 and year*12 + month <= ?)''', [last]),
+                    ('''delete from sync_state where key = ?''', ['compaction']),
+                    ]
+                with self.transaction():
+                    if self.read_sql(check, [last, stamp], single=True)[0] > 0:
+                        self.tx_failed = True
+                    for sql, params in compact:
+                        if not self.tx_failed:
+                            self.write_sql(sql, params)
+        if self.tx_failed:
+            return("sql_failure")
+        if vacuum:
+            self.curs.execute('''vacuum''')
+        return(count)
+
     def return_balances(self,html=False):
         results = self.envelope_balance()
         t = lambda x: " " if x == 0 else db_out(x)
@@ -424,26 +1839,7 @@ class budget:
         if results != "sql_failure":
             table_values = []
             if html:
-                for i in results:
-                    table_values.append([i[0], i[1],t(i[6]),i[4],i[5]])
-                document = '''<!DOCTYPE html><html>
-                                <head>
-                                <style>table, th, td{border:1px solid black; border-collapse: collapse};</style></head>
-                                <body>
-                                <h3>Balances</h3>
-                                <table style='width 100%'>
-                                <tr><th>ID</th><th>Account</th><th>Target</th><th>Spend</th><th>Balance</th></tr>
-                                '''
-
-                for row in table_values:
-                    #row_format = "<tr><td>{}</td><td>{}</td><td>{}</td></tr>\n"
-                    row_format = "<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td>{}</tr>\n"
-                    #document += row_format.format(row[0], row[1], self.html_emph(row[2]))
-                    document += row_format.format(row[0], row[1], t(row[2]),db_out(row[3]),self.text_color(db_out(row[4]), html=True))
-                document += "</table></body></html>"
-                f = open(html, 'w')
-                f.write(document)
-                f.close()
+                return(self.export_report(html, "html"))
 
             else:
                 for i in results:
@@ -451,6 +1847,241 @@ class budget:
                 print(tabulate(table_values, ["ID", "Account","Target", "Spend","Balance"], tablefmt="simple"))
 
 
+    def budget_range(self):
+        '''Return the (year, month) of the first and last budgets'''
+        sql = '''select min(year*12 + month - 1), max(year*12 + month - 1) from budgets'''
+        first, last = self.read_sql(sql, [], single=True)
+        if first == None:
+            return(None, None)
+        return((first//12, first%12 + 1), (last//12, last%12 + 1))
+
+    def history(self, start=None, end=None, accounts=None, archive=None):
+        '''Return envelope history for the budgets from start through end (year, month)
+
+        Values come back as (months x accounts) numpy arrays in currency
+        units: allocated, spent, carried (the 'C' carry into each month),
+        adjusted (every other correction) and balance. present marks the
+        cells with a budget_base row and closed the closed months. carry_ok
+        recomputes each closed month's carry into the next one and marks
+        where the stored carry agrees. Carries of compacted budgets are read
+        from corrections_archive, in the archive database when one is given.
+        accounts limits the columns to the given account ids or names.
+        Returns "sql_failure" if the query fails.'''
+        np = optional_module("numpy")
+        if np == None:
+            print("history needs numpy")
+            exit(22)
+        first, last = self.budget_range()
+        start = start or first
+        end = end or last
+        if start == None:
+            return(None)
+        first = int(start[0])*12 + int(start[1])
+        last = int(end[0])*12 + int(end[1])
+        where = ""
+        params = [first, last]
+        if accounts:
+            marks = ", ".join("?"*len(accounts))
+            where = "and (a.account_id in ({0}) or a.account_name in ({0}))".format(marks)
+            params += [str(x) for x in accounts]*2
+        sql = '''with ''' + carries_cte + '''
+                 select m.year*12 + m.month, a.account_id, m.closed,
+                     b.base_value, b.spending, coalesce(k.carried, 0), coalesce(c.total_correction, 0)
+                 from budgets m
+                 join budget_base b on b.budget_id = m.budget_id
+                 join accounts a on a.account_id = b.account_id
+                 left join envelope_totals c on c.budget_id = b.budget_id and c.account_id = b.account_id
+                 left join carries k on k.budget_id = b.budget_id and k.account_id = b.account_id
+                 where m.year*12 + m.month between ? and ? {where}'''
+        with self.attached_archive(archive) as schema:
+            results = self.read_sql(sql.format(schema=schema, where=where), params)
+        if results == "sql_failure":
+            return("sql_failure")
+        rows = np.array(results, dtype=np.int64).reshape(-1, 7)
+        ids = np.unique(rows[:, 1])
+        names = dict(self.read_sql('''select account_id, account_name from accounts''', []))
+        shape = (last - first + 1, len(ids))
+        m = rows[:, 0] - first
+        a = np.searchsorted(ids, rows[:, 1])
+        cells = {}
+        for key, column in (("allocated", 3), ("spent", 4), ("carried", 5), ("corrections", 6)):
+            cells[key] = np.zeros(shape, dtype=np.int64)
+            cells[key][m, a] = rows[:, column]
+        present = np.zeros(shape, dtype=bool)
+        present[m, a] = True
+        closed = np.zeros(shape[0], dtype=bool)
+        closed[m] = rows[:, 2] == 1
+        balance = cells["allocated"] + cells["corrections"] - cells["spent"]
+        # A closed month's balance is carried into the next month
+        carry_ok = np.ones(shape, dtype=bool)
+        check = closed[:-1, None] & present[1:]
+        carry_ok[1:] = ~check | (cells["carried"][1:] == balance[:-1])
+        return({"months": [((i - 1)//12, (i - 1)%12 + 1) for i in range(first, last + 1)],
+                "account_ids": ids,
+                "accounts": [names[i] for i in ids],
+                "allocated": cells["allocated"]/100,
+                "spent": cells["spent"]/100,
+                "carried": cells["carried"]/100,
+                "adjusted": (cells["corrections"] - cells["carried"])/100,
+                "balance": balance/100,
+                "present": present,
+                "closed": closed,
+                "carry_ok": carry_ok})
+
+    def trend(self, months=12, archive=None):
+        '''Print each envelope's balance over the months up to this budget'''
+        end = self.year*12 + self.month - 1
+        start = end - months + 1
+        h = self.history((start//12, start%12 + 1), (self.year, self.month), archive=archive)
+        if h == "sql_failure":
+            print("Failed to read the budget history")
+            return
+        if h == None or len(h["accounts"]) == 0:
+            print("No budgets in range")
+            return
+        table_values = []
+        for j, name in enumerate(h["accounts"]):
+            row = [h["account_ids"][j], name]
+            for i in range(len(h["months"])):
+                if not h["present"][i, j]:
+                    row.append("")
+                    continue
+                value = self.text_color("{:.2f}".format(h["balance"][i, j]))
+                # Flag carries that do not match the previous month's balance
+                row.append(value if h["carry_ok"][i, j] else value + "*")
+            table_values.append(row)
+        headers = ["ID", "Account"] + ["{}-{:02d}".format(y, m) for y, m in h["months"]]
+        print(tabulate(table_values, headers, tablefmt="simple", disable_numparse=True))
+        if not h["carry_ok"].all():
+            print("\n* carried balance differs from the previous month's closing balance")
+
+    def simulate(self, months=6, paths=2000, history=12, seed=None):
+        '''Project envelope balances forward under the current allocations
+
+        Starting from this budget's envelope balances, each path rolls
+        forward month by month, allocating the current base values and
+        spending a whole month drawn at random from the last history closed
+        months, so spending across accounts stays correlated. As when budgets
+        are closed, each month's full balance carries into the next. Returns
+        numpy arrays over accounts, with first_negative (paths x accounts)
+        holding the first month (1-based) a path goes below zero, or 0.'''
+        np = optional_module("numpy")
+        if np == None:
+            print("simulate needs numpy")
+            exit(22)
+        results = self.envelope_balance()
+        if results == "sql_failure" or len(results) == 0:
+            return(None)
+        ids = np.array([r[0] for r in results], dtype=np.int64)
+        start = np.array([r[5] for r in results], dtype=np.int64)
+        allocated = np.array([r[2] for r in results], dtype=np.int64)
+        sql = '''select m.year*12 + m.month, b.account_id, b.spending
+                 from budgets m join budget_base b on b.budget_id = m.budget_id
+                 where m.closed = 1
+                 and m.year*12 + m.month in
+                     (select year*12 + month from budgets
+                      where closed = 1 and year*12 + month < ?
+                      order by year desc, month desc limit ?)'''
+        rows = np.array(self.read_sql(sql, [self.year*12 + self.month, history]), dtype=np.int64).reshape(-1, 3)
+        rows = rows[np.isin(rows[:, 1], ids)]
+        if len(rows) == 0:
+            # Without closed months this month's spending is the only sample
+            spending = np.array([[r[4] for r in results]], dtype=np.int64)
+        else:
+            sampled, m = np.unique(rows[:, 0], return_inverse=True)
+            spending = np.zeros((len(sampled), len(ids)), dtype=np.int64)
+            # ids follow the accounts' name order, not their numeric order
+            order = np.argsort(ids)
+            spending[m, order[np.searchsorted(ids, rows[:, 1], sorter=order)]] = rows[:, 2]
+        rng = np.random.default_rng(seed)
+        draws = rng.integers(0, len(spending), size=(months, paths))
+        balance = np.tile(start, (paths, 1))
+        first_negative = np.zeros((paths, len(ids)), dtype=np.int64)
+        for month in range(months):
+            balance += allocated - spending[draws[month]]
+            first_negative[(first_negative == 0) & (balance < 0)] = month + 1
+        return({"account_ids": ids,
+                "accounts": [r[1] for r in results],
+                "start": start/100,
+                "target": np.array([r[6] for r in results])/100,
+                "samples": len(spending),
+                "final": balance/100,
+                "first_negative": first_negative})
+
+    def forecast(self, months=6, paths=2000, history=12, seed=None):
+        '''Print which envelopes are likely to go negative over the next months'''
+        sim = self.simulate(months, paths, history, seed)
+        if sim == None:
+            print("No envelopes to simulate")
+            return
+        np = optional_module("numpy")
+        hits = sim["first_negative"] > 0
+        when = np.where(hits, sim["first_negative"], np.nan)
+        low, median = np.percentile(sim["final"], [5, 50], axis=0)
+        table_values = []
+        for j, name in enumerate(sim["accounts"]):
+            if hits[:, j].any():
+                month = int(np.nanmedian(when[:, j])) + self.year*12 + self.month - 1
+                first = "{}-{:02d}".format(month//12, month%12 + 1)
+            else:
+                first = ""
+            table_values.append([sim["account_ids"][j], name, "{:.2f}".format(sim["start"][j]),
+                                 self.text_color("{:.2f}".format(median[j])), "{:.2f}".format(low[j]),
+                                 "{:.0%}".format(hits[:, j].mean()), first])
+        print("{} paths over {} months, spending drawn from {} months\n".format(paths, months, sim["samples"]))
+        print(tabulate(table_values, ["ID", "Account", "Balance", "Median", "5%", "P(negative)", "Typically negative from"],
+                       tablefmt="simple", disable_numparse=True))
+
+    def export_report(self, path, fmt=None, report="balances", first=None, last=None, archive=None):
+        '''Stream a report for the budgets from first through last (year, month) to path
+
+        Both default to this budget. fmt is one of report_formats and is
+        otherwise chosen from the file extension. Rows are written as they
+        are read, and the file is renamed into place once complete. A path
+        of "-" writes to stdout instead. Carries of compacted budgets are read
+        from corrections_archive, in the archive database when one is given.'''
+        if fmt == None and path == "-":
+            fmt = "plain"
+        elif fmt == None:
+            extension = os.path.splitext(path)[1].lower()
+            fmt = next((name for name, writer in report_formats.items() if extension in writer.extensions), "html")
+        first = first or (self.year, self.month)
+        last = last or first
+        params = [int(first[0])*12 + int(first[1]), int(last[0])*12 + int(last[1])]
+        with self.attached_archive(archive) as schema:
+            if path == "-":
+                try:
+                    self.write_report(sys.stdout, fmt, report, params, schema)
+                except sqlite3.Error:
+                    return("sql_failure")
+                return(0)
+            partial = "{}.{}.tmp".format(path, os.getpid())
+            try:
+                with open(partial, 'w', newline='') as out:
+                    self.write_report(out, fmt, report, params, schema)
+                os.replace(partial, path)
+            except sqlite3.Error:
+                os.remove(partial)
+                return("sql_failure")
+            except BaseException:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            return(0)
+
+    def write_report(self, out, fmt, report, params, schema="main"):
+        columns, sql = report_queries[report]
+        sql = sql.format(schema=schema)
+        writer = report_formats[fmt](out, report.capitalize(), columns, self.text_color)
+        writer.begin()
+        current = None
+        for row in self.dbobject.execute(sql, params):
+            if row[:2] != current:
+                current = row[:2]
+                writer.section(*current)
+            writer.row(row[0], row[1], row[2:])
+        writer.end()
+
     def text_color(self,txt,html=False):
         value = float(txt)
         if value > 0:
@@ -487,30 +2118,88 @@ class budget:
                 sql = '''update budgets set active = 1
                          where budget_id = ?'''
                 result = self.write_sql(sql, [self.budget_id])
+                # Spending is only loaded into active budgets, so a budget
+                # synced while planning is stale once it is activated
+                self.budget_active = True
+                self.sync()
 
     def deactivate_budget(self):
-        current_id = self.budget_id
-        sql = '''update budgets set active = 0, closed = 1
-                 where budget_id = ?'''
-        result = self.write_sql(sql, [current_id])
-        if result == 0:
-            balances = self.envelope_balance()
-            self.month = self.next_month
-            self.year = self.next_year
-            status = self.open_budget()
-            if status == 3:
-                self.get_budget_id()
-            carry_list = []
-            for i in balances:
-                carry_list.append([self.budget_id,i[0],'C',i[5]])
-            sql = '''insert into corrections values (?,?,?,?)'''
-            results = self.write_sql(sql, carry_list, single=False)
-            if results == 0:
-                print("Budget Closed")
-                exit(0)
-            else:
-                print("Error")
-                exit(0)
+        return(self.close_through(self.year, self.month))
+
+    def close_through(self, year, month):
+        '''Close every budget from the current one through year/month in one transaction
+
+        Each month's envelope balances are carried into the next month as 'C'
+        corrections with a set-based insert, creating any missing budgets on
+        the way. Income and spending for all the months are synced from the
+        ledger in a single pass first.'''
+        first = self.year*12 + self.month
+        last = int(year)*12 + int(month)
+        if last < first:
+            print("Cannot close through an earlier month")
+            return(16)
+        sql = '''select count(*) from budgets
+                 where year*12 + month between ? and ? and closed = 1'''
+        if self.read_sql(sql, [first, last], single=True)[0] > 0:
+            print("Budget already deactivated")
+            return(13)
+        self.sync_ledger()
+        with self.transaction():
+            self.reconcile_accounts()
+            months = [((m - 1)//12, (m - 1)%12 + 1) for m in range(first, last + 2)]
+            sql = '''insert or ignore into budgets (year, month) values (?, ?)'''
+            self.write_sql(sql, months, single=False)
+            # Closed accounts stay until the month they were last budgeted in is closed
+            sql = '''insert or ignore into budget_base
+                     select b.budget_id, a.account_id, 0, 0, 0
+                     from budgets b, accounts a
+                     where b.year*12 + b.month between ? and ?
+                     and (a.closed = 0 or a.account_id in
+                          (select account_id from budget_base where budget_id = ?))'''
+            self.write_sql(sql, [first, last + 1, self.budget_id])
+            self.sync_range(months[0], months[-1])
+            sql = '''insert into corrections
+                     select nb.budget_id, b.account_id, 'C',
+                         b.base_value + coalesce(c.total_correction, 0) - b.spending
+                     from budgets cb
+                     join budgets nb on nb.year*12 + nb.month = cb.year*12 + cb.month + 1
+                     join budget_base b on b.budget_id = cb.budget_id
+                     left join envelope_totals c
+                         on c.budget_id = b.budget_id and c.account_id = b.account_id
+                     where cb.year*12 + cb.month = ?'''
+            for m in range(first, last + 1):
+                # Each month's carry reads the totals the previous insert just updated
+                self.write_sql(sql, [m])
+            sql = '''update budgets set active = 0, closed = 1
+                     where year*12 + month between ? and ?'''
+            self.write_sql(sql, [first, last])
+        if self.tx_failed:
+            return(15)
+        self.month, self.year = months[-1][1], months[-1][0]
+        self.get_budget_id()
+        return(0)
+
+    def dispatch(self, command, params):
+        '''Run one named command with params; the serve daemon's entry point'''
+        if command == "status":
+            return(0)
+        elif command == "view":
+            # This month's default view: the planner until the budget is activated
+            if (not self.budget_active) and (not self.budget_closed):
+                return(self.base_planner())
+            return(self.return_balances())
+        elif command == "balances":
+            return(self.return_balances(html=params.get("html", False)))
+        elif command == "planner":
+            return(self.base_planner())
+        elif command == "adjust":
+            return(self.redistribute_envelopes(params["acc1"], params["acc2"], params["transfer"]))
+        elif command == "single":
+            return(self.single_correction(params["acct_id"], params["amount"]))
+        elif command == "target":
+            return(self.set_target(params["acct"], params["targ_val"]))
+        print("Unknown command:", command)
+        exit(19)
 
     def check_budget_status(self):
         sql = '''select active,closed from budgets where budget_id = ?'''
@@ -524,6 +2213,57 @@ class budget:
         else:
             self.budget_closed = False
 
+    def plan_allocations(self, months=3, statistic="mean", percentile=90):
+        '''Seed this budget's allocations from spending over the last closed months
+
+        statistic is one of plan_statistics, computed per account over the
+        latest `months` closed budgets before this one in a single statement.
+        "trend" projects a least-squares line one month ahead and
+        "percentile" uses the nearest-rank method.'''
+        if statistic not in plan_statistics:
+            print("Unknown statistic:", statistic)
+            return(17)
+        sql = '''
+            with window_budgets as
+                (select budget_id, year*12 + month as ym
+                 from budgets
+                 where closed = 1 and year*12 + month < ?
+                 order by ym desc
+                 limit ?),
+            ranked as
+                (select b.account_id, b.spending,
+                    row_number() over (partition by b.account_id order by w.ym) as x,
+                    row_number() over (partition by b.account_id order by b.spending) as r,
+                    count(*) over (partition by b.account_id) as n
+                 from budget_base b join window_budgets w on b.budget_id = w.budget_id),
+            window_sums as
+                (select account_id,
+                    count(*) * 1.0 as n,
+                    sum(x) * 1.0 as sx,
+                    sum(spending) * 1.0 as sy,
+                    avg(spending) as mean,
+                    avg(case when r in ((n + 1)/2, (n + 2)/2) then spending end) as median,
+                    max(spending) as maximum,
+                    max(case when r = max(1, (? * n + 99)/100) then spending end) as pct,
+                    (count(*)*sum(x*spending) - sum(x)*sum(spending)) * 1.0
+                        / nullif(count(*)*sum(x*x) - sum(x)*sum(x), 0) as slope
+                 from ranked
+                 group by account_id),
+            window_stats as
+                (select account_id, {} as value from window_sums)
+            update budget_base
+            set base_value = cast(round(window_stats.value) as integer)
+            from window_stats
+            where budget_base.budget_id = ?
+            and budget_base.account_id = window_stats.account_id
+            '''.format(plan_statistics[statistic])
+        params = [self.year*12 + self.month, int(months), int(percentile), self.budget_id]
+        results = self.write_sql(sql, params)
+        if results == 0:
+            return(0)
+        else:
+            return(6)
+
     def copy_allocations(self, allocations="base", targets=True):
         if allocations == "base":
             alloc = "base_value"
@@ -570,37 +2310,522 @@ class budget:
             return(6)
 
 
+class budget_server:
+    '''Long-running daemon answering budget commands over a Unix socket
+
+    Budgets are built once per month and kept with their connection and
+    parsed ledger. Between requests the ledger files are checked and, when
+    they change, every loaded budget is re-synced incrementally.'''
+    def __init__(self, path, db, beanfile, tempfile, interval=1.0, **options):
+        self.path = path
+        self.db, self.beanfile, self.tempfile = db, beanfile, tempfile
+        self.options = options
+        self.interval = interval
+        self.budgets = {}
+
+    def budget_key(self, month, year):
+        today = datetime.date.today()
+        return((int(year or today.year), int(month or today.month)))
+
+    def budget_for(self, month, year):
+        key = self.budget_key(month, year)
+        if key not in self.budgets:
+            self.budgets[key] = budget(self.db, self.beanfile, self.tempfile, key[1], key[0], **self.options)
+        return(self.budgets[key])
+
+    def watch(self):
+        '''Re-ingest the ledger into every loaded budget if any ledger file changed'''
+        if len(self.budgets) == 0:
+            return
+        first = next(iter(self.budgets.values()))
+        if first.ledger_changes() == "unchanged":
+            return
+        for b in self.budgets.values():
+            # Dropping the parsed entries makes a rebuild re-read the ledger,
+            # and the cache must not answer with the old fingerprint
+            b.ledger = None
+            b.ledger_synced = False
+            if b.cache != None:
+                b.cache.reset()
+            b.sync()
+
+    def handle(self, message):
+        output = io.StringIO()
+        response = {"status": 0}
+        if message.get("color"):
+            os.environ["FORCE_COLOR"] = "1"
+        else:
+            os.environ.pop("FORCE_COLOR", None)
+        try:
+            with contextlib.redirect_stdout(output):
+                b = self.budget_for(message.get("month"), message.get("year"))
+                b.check_budget_status()
+                response["result"] = b.dispatch(message["command"], message)
+                response["active"] = b.budget_active
+                response["closed"] = b.budget_closed
+        except SystemExit as e:
+            response["status"] = e.code if isinstance(e.code, int) else 1
+            # A budget that failed to build is not kept
+            self.budgets.pop(self.budget_key(message.get("month"), message.get("year")), None)
+        except Exception as e:
+            print("Error:", e, file=output)
+            response["status"] = 1
+        response["output"] = output.getvalue()
+        return(response)
+
+    def serve(self):
+        import socketserver
+        import signal
+        server = self
+        class handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                message = json.loads(self.rfile.readline())
+                self.wfile.write(json.dumps(server.handle(message)).encode('utf-8') + b'\n')
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Only the owner may talk to the daemon
+        mask = os.umask(0o077)
+        listener = socketserver.UnixStreamServer(self.path, handler)
+        os.umask(mask)
+        listener.timeout = self.interval
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+        try:
+            while True:
+                listener.handle_request()
+                self.watch()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.server_close()
+            os.unlink(self.path)
+
+
+class budget_client:
+    '''Stand-in for budget that forwards commands to a running serve daemon
+
+    Raises OSError on construction when no daemon is listening.'''
+    def __init__(self, path, month=None, year=None):
+        self.path = path
+        self.month, self.year = month, year
+        self.request("status")
+
+    def request(self, command, **params):
+        message = dict(params, command=command, month=self.month, year=self.year, color=sys.stdout.isatty())
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(self.path)
+            conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            reply = conn.makefile('rb').readline()
+        response = json.loads(reply)
+        print(response["output"], end='')
+        if response["status"] != 0:
+            exit(response["status"])
+        self.budget_active = response["active"]
+        self.budget_closed = response["closed"]
+        return(response["result"])
+
+    def return_balances(self, html=False):
+        if html:
+            html = os.path.abspath(html)
+        return(self.request("balances", html=html))
+
+    def base_planner(self):
+        return(self.request("planner"))
+
+    def redistribute_envelopes(self, acc1, acc2, transfer):
+        return(self.request("adjust", acc1=acc1, acc2=acc2, transfer=transfer))
+
+    def single_correction(self, acct_id, amount):
+        return(self.request("single", acct_id=acct_id, amount=amount))
+
+    def set_target(self, acct, targ_val):
+        return(self.request("target", acct=acct, targ_val=targ_val))
+
+
+# Per-account statistics over the planning window, as expressions over the
+# window_stats columns in plan_allocations
+plan_statistics = {
+    "mean": "mean",
+    "median": "median",
+    "max": "maximum",
+    "percentile": "pct",
+    "trend": "coalesce((sy - slope*sx)/n + slope*(n + 1), mean)",
+    }
+
+def batch_sync(b, options):
+    b.sync()
+    return(0)
+
+def batch_rollover(b, options):
+    b.ensure_synced()
+    if b.budget_closed:
+        print("Budget already deactivated")
+        return(13)
+    elif not b.budget_active:
+        print("Budget is not active")
+        return(14)
+    return(b.deactivate_budget())
+
+def batch_copy(b, options):
+    if b.budget_active:
+        print("Budget is already active")
+        return(4)
+    elif b.budget_closed:
+        print("Budget is closed")
+        return(5)
+    return(b.copy_allocations(options["copy"], options["copy_targets"]))
+
+def batch_export(b, options):
+    b.ensure_synced()
+    path = options["export"].format(entity=options["entity"], year=b.year, month=b.month)
+    if b.export_report(path) != 0:
+        print("Error")
+        return(1)
+    print("Exported {}".format(path))
+    return(0)
+
+batch_operations = {"sync": batch_sync,
+                    "rollover": batch_rollover,
+                    "copy": batch_copy,
+                    "export": batch_export}
+
+def batch_entity(options, operation, month, year):
+    '''Run a batch operation against one entity's budget; called in a pool worker'''
+    output = io.StringIO()
+    report = {"entity": options["entity"], "db": options["db"], "status": 0, "error": None}
+    start = time.perf_counter()
+    b = None
+    try:
+        with contextlib.redirect_stdout(output):
+            b = budget(options["db"], options["beanfile"], options["tempfile"], month, year,
+                       backend=options["backend"], cache=options["cache"],
+                       cache_size=options["cache_size"], lazy=True)
+            report["status"] = batch_operations[operation](b, options)
+    except SystemExit as e:
+        report["status"] = e.code if isinstance(e.code, int) else int(e.code != None)
+    except Exception as e:
+        report["status"] = 1
+        report["error"] = "{}: {}".format(type(e).__name__, e)
+    finally:
+        if b != None:
+            b.close()
+    report["elapsed"] = round(time.perf_counter() - start, 3)
+    report["output"] = output.getvalue()
+    return(report)
+
+
+class budget_batch:
+    '''Run one operation across every entity in a manifest on a process pool
+
+    The manifest is an ini file with a section per entity giving its db and
+    beanfile, and optionally tempfile, backend, cache, cache_size, copy
+    (base or spend), copy_targets and export (a path formatted with entity,
+    year and month). Keys left out fall back to the manifest's DEFAULT
+    section, then to the defaults passed in.'''
+    def __init__(self, manifest, defaults=None, jobs=None):
+        from configparser import ConfigParser
+        config = ConfigParser(defaults=defaults)
+        if len(config.read(manifest)) == 0:
+            print("Cannot read manifest {}".format(manifest))
+            exit(21)
+        self.jobs = jobs
+        self.entities = []
+        self.invalid = []
+        for name in config.sections():
+            section = config[name]
+            if "db" not in section or "beanfile" not in section:
+                self.invalid.append({"entity": name, "db": section.get("db"), "status": 1,
+                                     "error": "Manifest entry needs db and beanfile",
+                                     "elapsed": 0, "output": ""})
+                continue
+            self.entities.append({"entity": name,
+                                  "db": os.path.expandvars(section["db"]),
+                                  "beanfile": os.path.expandvars(section["beanfile"]),
+                                  "tempfile": os.path.expandvars(section.get("tempfile", "")),
+                                  "backend": section.get("backend"),
+                                  "cache": os.path.expandvars(section.get("cache", cache_file)),
+                                  "cache_size": section.getint("cache_size", 64),
+                                  "copy": section.get("copy", "base"),
+                                  "copy_targets": section.getboolean("copy_targets", True),
+                                  "export": os.path.expandvars(section.get("export", "{entity}-{year}-{month:02d}.html"))})
+
+    def run(self, operation, month=None, year=None):
+        '''Return a summary of the operation with each entity's status, output and timing'''
+        start = time.perf_counter()
+        reports = list(self.invalid)
+        if len(self.entities) > 0:
+            # Parsing a ledger in-process is CPU bound, so by default there is
+            # one worker per CPU
+            workers = min(self.jobs or os.cpu_count() or 1, len(self.entities))
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(batch_entity, options, operation, month, year) for options in self.entities]
+                for options, future in zip(self.entities, futures):
+                    try:
+                        reports.append(future.result())
+                    except Exception as e:
+                        reports.append({"entity": options["entity"], "db": options["db"], "status": 1,
+                                        "error": "{}: {}".format(type(e).__name__, e),
+                                        "elapsed": None, "output": ""})
+        return({"operation": operation,
+                "month": month,
+                "year": year,
+                "elapsed": round(time.perf_counter() - start, 3),
+                "failed": sum(1 for r in reports if r["status"] != 0),
+                "entities": reports})
+
+
+class profiler:
+    '''Time the ledger, tempfile, SQL and render phases of a run
+
+    output is "summary", "json" or None for only a cProfile dump.
+    install() wraps the instrumented budget methods in place, so while
+    profiling is off nothing is wrapped and nothing is measured. Times are
+    inclusive: a render that reads from the database also counts its SQL.'''
+    phases = {"run_beancount": "ledger",
+              "load_ledger": "ledger",
+              "write_temp": "tempfile",
+              "read_sql": "sql",
+              "write_sql": "sql",
+              "return_balances": "render",
+              "base_planner": "render",
+              "export_report": "render",
+              "trend": "render",
+              "forecast": "render"}
+
+    def __init__(self, output="summary", path=None, cprofile=None):
+        self.output = output
+        self.path = path
+        self.cprofile = cprofile
+        self.events = []
+        self.start = time.perf_counter()
+
+    def install(self):
+        if self.output:
+            for name, phase in self.phases.items():
+                setattr(budget, name, self.wrap(getattr(budget, name), name, phase))
+        if self.cprofile:
+            import cProfile
+            self.stats = cProfile.Profile()
+            self.stats.enable()
+        atexit.register(self.report)
+
+    def wrap(self, method, name, phase):
+        profile = self
+        @functools.wraps(method)
+        def timed(b, *args, **kwargs):
+            start = time.perf_counter()
+            result = method(b, *args, **kwargs)
+            profile.record(b, name, phase, start, args, result)
+            return(result)
+        return(timed)
+
+    def record(self, b, name, phase, start, args, result):
+        event = {"phase": phase, "name": name,
+                 "start": round(start - self.start, 6),
+                 "elapsed": time.perf_counter() - start}
+        if phase == "sql":
+            event["sql"] = " ".join(args[0].split())
+            if name == "read_sql":
+                event["rows"] = len(result) if isinstance(result, list) else int(isinstance(result, tuple))
+            else:
+                event["rows"] = b.curs.rowcount
+        self.events.append(event)
+
+    def summary(self):
+        phases = {}
+        for event in self.events:
+            totals = phases.setdefault((event["phase"], event["name"]), [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += event["elapsed"]
+            totals[2] += max(event.get("rows", 0), 0)
+        return(phases)
+
+    def report(self):
+        if self.cprofile:
+            self.stats.disable()
+            self.stats.dump_stats(self.cprofile)
+        if not self.output:
+            return
+        total = time.perf_counter() - self.start
+        if self.output == "json":
+            trace = {"total": total,
+                     "phases": [{"phase": phase, "name": name, "calls": calls, "elapsed": elapsed, "rows": rows}
+                                for (phase, name), (calls, elapsed, rows) in self.summary().items()],
+                     "events": self.events}
+            if self.path:
+                with open(self.path, 'w') as f:
+                    json.dump(trace, f, indent=2)
+            else:
+                print(json.dumps(trace), file=sys.stderr)
+            return
+        table_values = [[phase, name, calls, "{:.4f}".format(elapsed), "{:.3f}".format(1000*elapsed/calls), rows]
+                        for (phase, name), (calls, elapsed, rows) in sorted(self.summary().items())]
+        table_values.append(["total", "", "", "{:.4f}".format(total), "", ""])
+        statements = {}
+        for event in self.events:
+            if "sql" in event:
+                totals = statements.setdefault(event["sql"][:70], [0, 0.0])
+                totals[0] += 1
+                totals[1] += event["elapsed"]
+        slowest = sorted(statements.items(), key=lambda item: -item[1][1])[:10]
+        out = open(self.path, 'w') if self.path else sys.stderr
+        print(tabulate(table_values, ["Phase", "Method", "Calls", "Total s", "Mean ms", "Rows"],
+                       tablefmt="simple", disable_numparse=True), file=out)
+        if slowest:
+            print("", file=out)
+            print(tabulate([[sql, calls, "{:.4f}".format(elapsed)] for sql, (calls, elapsed) in slowest],
+                           ["Slowest SQL", "Calls", "Total s"], tablefmt="simple", disable_numparse=True), file=out)
+        if self.path:
+            out.close()
+
+
 def main():
+    import argparse
+    from configparser import ConfigParser
     config = ConfigParser()
     config.read(config_file)
 
     db = os.path.expandvars(config.get("DEFAULT", "db"))
     beanfile = os.path.expandvars(config.get("DEFAULT", "beanfile"))
-    tempfile = os.path.expandvars(config.get("DEFAULT", "tempfile"))
+    tempfile = os.path.expandvars(config.get("DEFAULT", "tempfile", fallback=""))
+    backend = config.get("DEFAULT", "backend", fallback=None)
+    cache = os.path.expandvars(config.get("DEFAULT", "cache", fallback=cache_file))
+    cache_size = config.getint("DEFAULT", "cache_size", fallback=64)
+    archive = os.path.expandvars(config.get("DEFAULT", "archive", fallback=""))
+    socket_path = os.path.expandvars(config.get("DEFAULT", "socket", fallback=socket_file))
+    sync_max_age = config.getint("DEFAULT", "sync_max_age", fallback=0)
 
     parser = argparse.ArgumentParser(description="Manage budgets based on beancount file data")
+    parser.add_argument("command", nargs="?", default=None, choices=["serve", "batch", "apply", "audit"], help="Run the budget daemon (serve), a batch operation over a manifest (batch), a script of envelope operations (apply) or an integrity check of every budget (audit)")
+    parser.add_argument("--ops", action="store", dest="ops", default="-", help="File of operations for apply [stdin]")
+    parser.add_argument("--dry-run", action="store_true", dest="dry_run", default=False, help="Only validate the operations given to apply")
+    parser.add_argument("--repair-sql", action="store", dest="repair_sql", default=None, help="Write SQL repairing what audit finds to a file ('-' for stdout)")
+    parser.add_argument("--allow-unbalanced", action="store_true", dest="allow_unbalanced", default=False, help="Let apply leave allocations that do not balance income")
+    parser.add_argument("--manifest", action="store", dest="manifest", default=None, help="Manifest of entities for batch")
+    parser.add_argument("--operation", action="store", dest="operation", default="sync", choices=sorted(batch_operations), help="Operation run by batch [sync]")
+    parser.add_argument("--jobs", action="store", dest="jobs", default=None, type=int, help="Worker processes used by batch [one per CPU]")
+    parser.add_argument("--summary", action="store", dest="summary", default=None, help="Write the batch summary to a file instead of stdout")
+    parser.add_argument("--profile", action="store_true", dest="profile", default=False, help="Time the phases of the run and report them on stderr")
+    parser.add_argument("--profile-format", action="store", dest="profile_format", default=None, choices=["summary", "json"], help="Report --profile as a summary table or a JSON trace [summary]")
+    parser.add_argument("--profile-out", action="store", dest="profile_out", default=None, help="Write the --profile report to a file")
+    parser.add_argument("--cprofile", action="store", dest="cprofile", default=None, help="Dump cProfile statistics to a file")
+    parser.add_argument("--sync", action="store_const", const=True, dest="sync", default=None, help="Always sync the budget with the ledger")
+    parser.add_argument("--no-sync", action="store_const", const=False, dest="sync", help="Never sync the budget with the ledger")
+    parser.add_argument("--standalone", action="store_true", dest="standalone", default=False, help="Do not use a running daemon")
     parser.add_argument("-m", action="store", dest="month", default=None, help="Set budget month")
     parser.add_argument("-y", action="store", dest="year", default=None, help="Set budget year")
     parser.add_argument("-e", action="store_true", dest="edit", default=False, help="Edit base budget allocations")
     parser.add_argument("-a", action="store_true", dest="adjust", default=False, help="Adjust envelope balances")
     parser.add_argument("-b", action="store_true", dest="budget_init", default=False, help="Initialise a new budget month")
     parser.add_argument("-H", action="store", dest="html_dest", default=None,help="Save balances to html file")
+    parser.add_argument("--trend", action="store", dest="trend", default=None, type=int, nargs="?", const=12, help="Show envelope balances over the last N months [12]")
+    parser.add_argument("--simulate", action="store", dest="simulate", default=None, type=int, nargs="?", const=6, help="Simulate envelope balances over the next N months [6]")
+    parser.add_argument("--paths", action="store", dest="paths", default=2000, type=int, help="Number of paths used by --simulate [2000]")
+    parser.add_argument("--history", action="store", dest="history", default=12, type=int, help="Closed months of spending sampled by --simulate [12]")
+    parser.add_argument("--seed", action="store", dest="seed", default=None, type=int, help="Random seed used by --simulate")
+    parser.add_argument("--export", action="store", dest="export", default=None, help="Stream a report to a file")
+    parser.add_argument("--format", action="store", dest="format", default=None, choices=sorted(report_formats), help="Report format used by --export [from the file extension], or print this month's view in it")
+    parser.add_argument("--report", action="store", dest="report", default="balances", choices=sorted(report_queries), help="Report written by --export [balances]")
+    parser.add_argument("--export-from", action="store", dest="export_from", default=None, help="First month exported, YYYY-MM [budget month]")
+    parser.add_argument("--export-through", action="store", dest="export_through", default=None, help="Last month exported, YYYY-MM [budget month]")
+    parser.add_argument("--all-months", action="store_true", dest="all_months", default=False, help="Export every month since the first budget")
     parser.add_argument("-A", action="store_true", dest="activate", default=False, help="Activate a budget")
     parser.add_argument("-D", action="store_true", dest="deactivate", default=False, help="Deactivate budget")
     parser.add_argument("-c", action="store_true", dest="copy", default=False, help="Copy base budget values from last month")
+    parser.add_argument("-p", action="store", dest="plan", default=None, choices=sorted(plan_statistics), help="Plan base values from a statistic of recent spending")
+    parser.add_argument("-w", action="store", dest="window", default=3, type=int, help="Number of closed months used by -p [3]")
+    parser.add_argument("--percentile", action="store", dest="percentile", default=90, type=int, help="Spending percentile used by -p percentile [90]")
     parser.add_argument("-s", action="store_true", dest="single_correction", default=False,help="Apply a single account correction")
     parser.add_argument("-t", action="store_true", dest="set_target", default=False,help="Set an account target value")
+    parser.add_argument("--explain", action="store_true", dest="explain", default=False, help="Show query plans for the core budget queries")
+    parser.add_argument("--rebuild-totals", action="store_true", dest="rebuild_totals", default=False, help="Recompute the stored envelope correction totals")
+    parser.add_argument("--close-through", action="store", dest="close_through", default=None, help="Deactivate every month through YYYY-MM, carrying balances forward")
+    parser.add_argument("--compact-through", action="store", dest="compact_through", default=None, help="Snapshot and archive the corrections of closed budgets through YYYY-MM")
+    parser.add_argument("--vacuum", action="store_true", dest="vacuum", default=False, help="Reclaim free space after --compact-through")
+    parser.add_argument("--sync-all", action="store_true", dest="sync_all", default=False, help="Refresh income and spending for every open budget from the ledger")
     #parser.add_argument("-u", action="store_true", dest="update", default=False,help="Update budget with new expense accounts (NOT IMPLEMENTED)")
 
     args = parser.parse_args()
 
-    if args.budget_init:
-        b = budget(db, beanfile,tempfile,args.month,args.year,init=True)
+    # Profiling can also be switched on for unattended runs from the
+    # environment, where BEANVELOPE_PROFILE=json picks the JSON trace
+    environ_profile = os.environ.get("BEANVELOPE_PROFILE")
+    profile = args.profile or args.profile_format or environ_profile
+    profile_out = args.profile_out or os.environ.get("BEANVELOPE_PROFILE_OUT")
+    cprofile = args.cprofile or os.environ.get("BEANVELOPE_CPROFILE")
+    if profile or cprofile:
+        output = profile and (args.profile_format or ("json" if environ_profile == "json" else "summary"))
+        profiler(output, profile_out, cprofile).install()
+
+    # Commands the daemon can answer; everything else always runs standalone
+    daemon_command = not (args.command == "apply" or args.budget_init or args.activate or args.deactivate or args.edit
+                          or args.copy or args.plan or args.explain or args.rebuild_totals
+                          or args.close_through or args.compact_through or args.sync_all or args.export or args.trend or args.simulate or args.format)
+
+    if args.command == "serve":
+        server = budget_server(socket_path, db, beanfile, tempfile, backend=backend, cache=cache, cache_size=cache_size)
+        server.serve()
+        exit()
+    elif args.command == "batch":
+        if args.manifest == None:
+            print("batch needs --manifest")
+            exit(21)
+        defaults = {"cache": cache, "cache_size": str(cache_size)}
+        if backend != None:
+            defaults["backend"] = backend
+        summary = budget_batch(args.manifest, defaults, args.jobs).run(args.operation, args.month, args.year)
+        if args.summary:
+            with open(args.summary, 'w') as f:
+                json.dump(summary, f, indent=2)
+        else:
+            print(json.dumps(summary, indent=2))
+        if summary["failed"] > 0:
+            exit(21)
+        exit()
+    elif args.command == "audit":
+        # Audit only reads, and checks every budget rather than this month's
+        b = budget(db, beanfile, tempfile, backend=backend, database_only=True)
+        findings = b.audit(archive)
+        if findings == "sql_failure":
+            print("Error")
+            exit(1)
+        if args.repair_sql == "-":
+            print("\n".join(b.audit_repairs(findings)))
+        else:
+            b.audit_report(findings)
+            if args.repair_sql:
+                with open(args.repair_sql, 'w') as f:
+                    f.write("\n".join(b.audit_repairs(findings)) + "\n")
+        if len(findings) > 0:
+            exit(24)
+        exit()
+    elif args.budget_init:
+        b = budget(db, beanfile,tempfile,args.month,args.year,init=True,backend=backend,cache=cache,cache_size=cache_size)
         exit()
     else:
-        b = budget(db, beanfile,tempfile,args.month,args.year)
+        b = None
+        if daemon_command and not args.standalone:
+            try:
+                b = budget_client(socket_path, args.month, args.year)
+            except OSError:
+                pass
+        if b == None:
+            b = budget(db, beanfile,tempfile,args.month,args.year,backend=backend,cache=cache,cache_size=cache_size,lazy=True,sync_max_age=sync_max_age)
+            b.ensure_synced(args.sync)
     
-        if args.activate:
+        if args.command == "apply":
+            if args.ops == "-":
+                lines = sys.stdin.readlines()
+            else:
+                with open(args.ops) as f:
+                    lines = f.readlines()
+            result = b.apply_operations(lines, args.allow_unbalanced, args.dry_run)
+            if result != 0:
+                exit(result)
+
+
+        elif args.activate:
             if b.budget_closed:
                 print("Budget cannot be reactivated")
                 exit(11)
@@ -617,7 +2842,12 @@ def main():
             elif not b.budget_active:
                 print("Budget is not active")
                 exit(14)
-            b.deactivate_budget()
+            result = b.deactivate_budget()
+            if result == 0:
+                print("Budget Closed")
+            else:
+                print("Error")
+                exit(result)
 
         # Adjustment envelopes
         elif args.adjust:
@@ -710,9 +2940,41 @@ def main():
                     exit(0)
                 b.set_base_envelope(int(selected_acct), budget_value)
 
+        elif args.plan:
+            if b.budget_active:
+                print("Budget is already active")
+                exit(4)
+            elif b.budget_closed:
+                print("Budget is closed")
+                exit(5)
+            result = b.plan_allocations(args.window, args.plan, args.percentile)
+            if result == 0:
+                print("\033[H\033[J")
+                b.base_planner()
+            else:
+                print("Error")
+                exit(result)
+
         elif args.html_dest:
             b.return_balances(html=args.html_dest)
 
+        elif args.simulate:
+            b.forecast(args.simulate, args.paths, args.history, args.seed)
+
+        elif args.trend:
+            b.trend(args.trend, archive)
+
+        elif args.export:
+            if args.all_months:
+                first, last = b.budget_range()
+            else:
+                first = args.export_from.split("-") if args.export_from else (b.year, b.month)
+                last = args.export_through.split("-") if args.export_through else (b.year, b.month)
+            result = b.export_report(args.export, args.format, args.report, first, last, archive)
+            if result != 0:
+                print("Error")
+                exit(1)
+
         elif args.copy:
             alloc = input("Copy (b)ase values or (s)pending? [b]: ")
             if alloc == "s":
@@ -736,10 +2998,57 @@ def main():
             else:
                 print("Error")
 
+        elif args.close_through:
+            if b.budget_closed:
+                print("Budget already deactivated")
+                exit(13)
+            elif not b.budget_active:
+                print("Budget is not active")
+                exit(14)
+            year, month = args.close_through.split("-")
+            result = b.close_through(year, month)
+            if result == 0:
+                print("Budgets closed through {}".format(args.close_through))
+            else:
+                print("Error")
+                exit(result)
+
+        elif args.compact_through:
+            year, month = args.compact_through.split("-")
+            result = b.compact_corrections(year, month, archive, args.vacuum)
+            if result == "sql_failure":
+                print("Error")
+                exit(1)
+            print("Compacted {} budgets".format(result))
+
+        elif args.explain:
+            b.explain_queries()
+
+        elif args.rebuild_totals:
+            if b.rebuild_envelope_totals() != 0:
+                print("Error")
+                exit(1)
+            print("Envelope totals rebuilt")
+
+        elif args.sync_all:
+            result = b.sync_range()
+            if result == "sql_failure":
+                print("Error")
+                exit(1)
+            print("Synced {} budgets".format(result))
+
         #elif args.update:
         #    b.update_missing()
 
-            
+        elif args.format:
+            if (not b.budget_active) and (not b.budget_closed):
+                result = b.export_report("-", args.format, "planner", archive=archive)
+            else:
+                result = b.export_report("-", args.format, "balances")
+            if result != 0:
+                print("Error")
+                exit(1)
+
         else:
             print("\033[H\033[J")
             if (not b.budget_active) and (not b.budget_closed):
@@ -51,5 +51,6 @@ create table filter_mods
 	(account_id integer,
 	filter_text text,
 	foreign key(account_id) references accounts(account_id)
-)
+);
 
+-- later schema changes are applied by the migrations list in beanvelope.py
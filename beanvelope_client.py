@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+'''Thin client for a running beanvelope serve daemon
+
+This month's view and -H exports are answered by the daemon with nothing
+heavier than socket and json imported. Every other command, and any run
+with no daemon listening, is handed to beanvelope.main.'''
+
+import os
+import sys
+import json
+import socket
+
+config_file = os.path.expandvars("$HOME/.config/beanvelope/beanvelope.conf")
+socket_file = "$HOME/.cache/beanvelope/beanvelope.sock"
+
+
+def quick_args(argv):
+    '''Return (month, year, html) if argv only asks for a view the daemon answers, else None'''
+    if len(argv) % 2 != 0:
+        return(None)
+    values = {"-m": None, "-y": None, "-H": None}
+    for flag, value in zip(argv[::2], argv[1::2]):
+        if flag not in values or value.startswith("-"):
+            return(None)
+        values[flag] = value
+    return(values["-m"], values["-y"], values["-H"])
+
+
+def socket_path():
+    from configparser import ConfigParser
+    config = ConfigParser()
+    config.read(config_file)
+    return(os.path.expandvars(config.get("DEFAULT", "socket", fallback=socket_file)))
+
+
+def request(path, message):
+    '''Send one command to the daemon and return its response'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        reply = conn.makefile('rb').readline()
+    return(json.loads(reply))
+
+
+def main():
+    quick = quick_args(sys.argv[1:])
+    if quick != None:
+        month, year, html = quick
+        message = {"command": "balances" if html else "view", "month": month, "year": year,
+                   "html": html and os.path.abspath(html), "color": sys.stdout.isatty()}
+        try:
+            response = request(socket_path(), message)
+        except OSError:
+            response = None
+        if response != None:
+            if not html:
+                print("\033[H\033[J")
+            print(response["output"], end='')
+            if response["status"] == 0 and not html:
+                print("\n")
+            exit(response["status"])
+    import beanvelope
+    beanvelope.main()
+
+if __name__ == "__main__":
+    main()
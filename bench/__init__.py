@@ -0,0 +1,5 @@
+'''Benchmarks for beanvelope
+
+generate builds synthetic ledgers and matching budget databases,
+fake_bean_query stands in for bean-query when running offline and harness
+times the budget lifecycle. Run it with python -m bench.'''
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+'''Offline stand-in for bean-query
+
+Answers the queries beanvelope issues from the <beanfile>.answers.json
+written by generate, in bean-query's text layout. Filter clauses are
+ignored, so benchmark databases should not use filter_mods.'''
+
+import sys
+import json
+
+
+def main():
+    beanfile, query = sys.argv[1], sys.argv[2]
+    with open(beanfile + ".answers.json") as f:
+        answers = json.load(f)
+    if query.startswith("print"):
+        for account, opened in answers["accounts"]:
+            print("{} open {:<40}  USD".format(opened, account))
+    elif "'Income'" in query:
+        print("year  month  'Income'  sum_position")
+        print("----  -----  --------  ------------")
+        for year, month, value in answers["income"]:
+            print("{:4d}  {:5d}  Income  {} USD".format(year, month, value))
+    else:
+        print("year  month  account  sum_position")
+        print("----  -----  -------  ------------")
+        for year, month, account, value in answers["expenses"]:
+            # bean-query prints nothing for an inventory summing to zero
+            amount = "" if value == "0.00" else "{} USD".format(value)
+            print("{:4d}  {:5d}  {:<40}  {}".format(year, month, account, amount))
+
+if __name__ == "__main__":
+    main()
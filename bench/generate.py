@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import random
+import sqlite3
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import beanvelope
+
+schema_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "beanvelope.sql")
+
+
+def cents(value):
+    sign = "-" if value < 0 else ""
+    return("{}{}.{:02d}".format(sign, abs(value)//100, abs(value)%100))
+
+
+def month_range(start_year, years):
+    return([(start_year + k//12, k%12 + 1) for k in range(years*12)])
+
+
+def generate_ledger(directory, accounts=20, years=3, transactions=100, includes=4, start_year=2020, seed=0):
+    '''Write a synthetic ledger to directory and return its monthly aggregates
+
+    The main file opens every account and includes the transactions spread
+    over the given number of files. The aggregates are also saved next to
+    the ledger as <main>.answers.json for fake_bean_query.'''
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(directory, "txns"), exist_ok=True)
+    expense_accounts = ["Expenses:Category{:03d}".format(i) for i in range(accounts)]
+    main = os.path.join(directory, "main.beancount")
+    months = month_range(start_year, years)
+    expenses = {}
+    income = {}
+    files = [[] for i in range(max(includes, 1))]
+    for k, (year, month) in enumerate(months):
+        out = files[k % len(files)]
+        salary = 500000 + rng.randrange(0, 100000)
+        income[(year, month)] = -salary
+        out.append('{}-{:02d}-01 * "Salary"\n  Income:Salary  {} USD\n  Assets:Bank\n\n'.format(year, month, cents(-salary)))
+        card = 0
+        for t in range(transactions):
+            account = rng.choice(expense_accounts)
+            amount = rng.randrange(100, 20000)
+            day = rng.randrange(1, 29)
+            key = (year, month, account)
+            expenses[key] = expenses.get(key, 0) + amount
+            if rng.random() < 0.3:
+                card += amount
+                source = "Liabilities:Card"
+            else:
+                source = "Assets:Bank"
+            out.append('{}-{:02d}-{:02d} * "Purchase {}"\n  {}  {} USD\n  {}\n\n'.format(year, month, day, t, account, cents(amount), source))
+        # Card postings count as spending in the card account, and the
+        # payment at the end of the month brings it back
+        if card > 0:
+            out.append('{}-{:02d}-28 * "Card payment"\n  Liabilities:Card  {} USD\n  Assets:Bank\n\n'.format(year, month, cents(card)))
+            expenses[(year, month, "Liabilities:Card")] = 0
+
+    with open(main, 'w') as f:
+        f.write('option "operating_currency" "USD"\n\n')
+        opened = "{}-01-01".format(start_year - 1)
+        for account in ["Assets:Bank", "Income:Salary", "Liabilities:Card"] + expense_accounts:
+            f.write("{} open {}\n".format(opened, account))
+        f.write("\n")
+        for i, lines in enumerate(files):
+            path = os.path.join("txns", "{:03d}.beancount".format(i))
+            with open(os.path.join(directory, path), 'w') as t:
+                t.write("".join(lines))
+            f.write('include "{}"\n'.format(path))
+
+    answers = {"expenses": [[y, m, a, cents(v)] for (y, m, a), v in sorted(expenses.items())],
+               "income": [[y, m, cents(v)] for (y, m), v in sorted(income.items())],
+               "accounts": [[a, opened] for a in sorted(expense_accounts + ["Liabilities:Card"])]}
+    with open(main + ".answers.json", 'w') as f:
+        json.dump(answers, f)
+    return(main, answers, expenses, income, months)
+
+
+def generate_database(path, ledger, answers, expenses, income, months, corrections=10, seed=0):
+    '''Write a budget database covering months with a closed history
+
+    Every month but the last is closed, with its carry and the given number
+    of envelope transfers, and the last month is active. Allocations always
+    balance income.'''
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    dbobject = sqlite3.connect(path)
+    with open(schema_file) as f:
+        dbobject.executescript(f.read())
+    accounts = [a for a, opened in answers["accounts"]]
+    dbobject.executemany('''insert into accounts (account_id, account_name) values (?, ?)''',
+                         [(i + 1, a) for i, a in enumerate(accounts)])
+    ids = range(1, len(accounts) + 1)
+    balance = dict((i, 0) for i in ids)
+    for k, (year, month) in enumerate(months):
+        budget_id = k + 1
+        last = k == len(months) - 1
+        dbobject.execute('''insert into budgets values (?, ?, ?, ?, ?)''', [budget_id, year, month, int(last), int(not last)])
+        available = -income[months[k - 1]] if k > 0 else 0
+        dbobject.execute('''insert into income values (?, ?)''', [budget_id, available])
+        share = available // len(accounts)
+        rows = []
+        carries = []
+        for i, account in zip(ids, accounts):
+            base = share + (available - share*len(accounts) if i == 1 else 0)
+            spending = expenses.get((year, month, account), 0)
+            rows.append((budget_id, i, base, rng.choice([0, 0, base]), spending))
+            carries.append((budget_id, i, 'C', balance[i]))
+        dbobject.executemany('''insert into budget_base values (?, ?, ?, ?, ?)''', rows)
+        dbobject.executemany('''insert into corrections values (?, ?, ?, ?)''', carries)
+        adjustments = []
+        for c in range(corrections):
+            acc1, acc2 = rng.sample(list(ids), 2)
+            amount = rng.randrange(100, 10000)
+            adjustments += [(budget_id, acc1, 'A', -amount), (budget_id, acc2, 'A', amount)]
+        dbobject.executemany('''insert into corrections values (?, ?, ?, ?)''', adjustments)
+        for budget_id, i, base, target, spending in rows:
+            balance[i] += base - spending
+        for budget_id, i, kind, value in adjustments:
+            balance[i] += value
+    dbobject.commit()
+    dbobject.close()
+    # Bring the schema up to date; a lazy budget does not touch the ledger
+    year, month = months[-1]
+    b = beanvelope.budget(path, ledger, "", month, year, lazy=True)
+    b.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic ledger and budget database")
+    parser.add_argument("directory", help="Output directory")
+    parser.add_argument("--accounts", type=int, default=20, help="Expense accounts [20]")
+    parser.add_argument("--years", type=int, default=3, help="Years of history [3]")
+    parser.add_argument("--transactions", type=int, default=100, help="Transactions per month [100]")
+    parser.add_argument("--includes", type=int, default=4, help="Included transaction files [4]")
+    parser.add_argument("--corrections", type=int, default=10, help="Envelope transfers per month [10]")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed [0]")
+    args = parser.parse_args()
+    ledger, answers, expenses, income, months = generate_ledger(args.directory, args.accounts, args.years,
+                                                                args.transactions, args.includes, seed=args.seed)
+    generate_database(os.path.join(args.directory, "budget.db"), ledger, answers, expenses, income, months,
+                      args.corrections, args.seed)
+    print("Wrote {} and {}".format(ledger, os.path.join(args.directory, "budget.db")))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import statistics
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import beanvelope
+from bench import generate
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+steps = ["sync_cold", "sync_warm", "base_planner", "envelope_balance", "return_balances",
+         "return_balances_html", "deactivate_budget", "copy_allocations", "open_budget"]
+
+
+def next_month(year, month):
+    return((year + 1, 1) if month == 12 else (year, month + 1))
+
+
+def timed(results, step, call):
+    start = time.perf_counter()
+    value = call()
+    results.setdefault(step, []).append(time.perf_counter() - start)
+    return(value)
+
+
+def install_fake_bean_query(directory):
+    '''Put a bean-query wrapper around fake_bean_query first on the PATH'''
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "bean-query")
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, os.path.join(repo_dir, "bench", "fake_bean_query.py")))
+    os.chmod(path, 0o755)
+    os.environ["PATH"] = directory + os.pathsep + os.environ["PATH"]
+
+
+def run_lifecycle(work, template, ledger, year, month, backend, results):
+    '''Time one pass through a budget's lifecycle on a fresh copy of the database'''
+    db = os.path.join(work, "budget.db")
+    cache = os.path.join(work, "cache.db")
+    os.makedirs(work, exist_ok=True)
+    for path in (db, db + "-wal", db + "-shm", cache):
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.copy(template, db)
+    options = {"backend": backend, "cache": cache}
+    with contextlib.redirect_stdout(io.StringIO()):
+        b = timed(results, "sync_cold", lambda: beanvelope.budget(db, ledger, "", month, year, **options))
+        timed(results, "sync_warm", lambda: beanvelope.budget(db, ledger, "", month, year, **options)).close()
+        timed(results, "base_planner", b.base_planner)
+        timed(results, "envelope_balance", b.envelope_balance)
+        timed(results, "return_balances", b.return_balances)
+        timed(results, "return_balances_html", lambda: b.return_balances(html=os.path.join(work, "balances.html")))
+        timed(results, "deactivate_budget", b.deactivate_budget)
+        b.close()
+        year, month = next_month(year, month)
+        b = beanvelope.budget(db, ledger, "", month, year, lazy=True, **options)
+        timed(results, "copy_allocations", lambda: b.copy_allocations("base", True))
+        b.close()
+        year, month = next_month(year, month)
+        timed(results, "open_budget", lambda: beanvelope.budget(db, ledger, "", month, year, init=True, **options)).close()
+
+
+def version():
+    '''Identify the beanvelope under test'''
+    with open(os.path.join(repo_dir, "beanvelope.py"), 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    try:
+        git = subprocess.run(["git", "-C", repo_dir, "describe", "--always", "--dirty"],
+                             capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        git = None
+    return({"git": git, "sha256": digest})
+
+
+def compare(old, new):
+    '''Print the median time of each step in two result files side by side'''
+    with open(old) as f:
+        a = json.load(f)["steps"]
+    with open(new) as f:
+        b = json.load(f)["steps"]
+    table_values = []
+    for step in a:
+        if step in b:
+            ratio = b[step]["median"]/a[step]["median"] if a[step]["median"] else None
+            table_values.append([step, "{:.4f}".format(a[step]["median"]), "{:.4f}".format(b[step]["median"]),
+                                 "" if ratio == None else "{:.2f}x".format(ratio)])
+    print(tabulate(table_values, ["Step", old, new, "Ratio"], tablefmt="simple", disable_numparse=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the beanvelope budget lifecycle on synthetic data")
+    parser.add_argument("--accounts", type=int, default=20, help="Expense accounts [20]")
+    parser.add_argument("--years", type=int, default=3, help="Years of history [3]")
+    parser.add_argument("--transactions", type=int, default=100, help="Transactions per month [100]")
+    parser.add_argument("--includes", type=int, default=4, help="Included transaction files [4]")
+    parser.add_argument("--corrections", type=int, default=10, help="Envelope transfers per month [10]")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed [0]")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each step [3]")
+    parser.add_argument("--backend", default="fake", choices=["fake", "bean-query", "beancount"],
+                        help="Ledger backend; fake answers bean-query queries offline [fake]")
+    parser.add_argument("--output", default=None, help="Write the results to a file instead of stdout")
+    parser.add_argument("--keep", default=None, help="Generate the data in this directory and keep it")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), default=None, help="Compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    work = args.keep or tempfile.mkdtemp(prefix="beanvelope-bench-")
+    try:
+        if args.backend == "fake":
+            install_fake_bean_query(os.path.join(work, "bin"))
+        backend = "beancount" if args.backend == "beancount" else "bean-query"
+        start = time.perf_counter()
+        ledger, answers, expenses, income, months = generate.generate_ledger(
+            work, args.accounts, args.years, args.transactions, args.includes, seed=args.seed)
+        template = os.path.join(work, "template.db")
+        generate.generate_database(template, ledger, answers, expenses, income, months, args.corrections, args.seed)
+        generated = time.perf_counter() - start
+        year, month = months[-1]
+        results = {}
+        for i in range(args.repeat):
+            run_lifecycle(os.path.join(work, "run"), template, ledger, year, month, backend, results)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    report = {"beanvelope": version(),
+              "python": sys.version.split()[0],
+              "sqlite": beanvelope.sqlite3.sqlite_version,
+              "backend": args.backend,
+              "params": {"accounts": args.accounts, "years": args.years, "transactions": args.transactions,
+                         "includes": args.includes, "corrections": args.corrections, "seed": args.seed,
+                         "repeat": args.repeat},
+              "generate": round(generated, 4),
+              "steps": dict((step, {"min": min(results[step]),
+                                    "median": statistics.median(results[step]),
+                                    "runs": results[step]}) for step in steps)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench import generate
+from bench import harness
+
+# Quick commands that scripts and status bars run often
+commands = {"help": ["-h"],
+            "plain": ["--format", "plain"],
+            "jsonl": ["--format", "jsonl"],
+            "html": ["-H", "{work}/balances.html"],
+            "table": []}
+
+
+def run_command(script, args, env, standalone=True):
+    '''Run one command under -X importtime; return wall time, import time and module count'''
+    if standalone:
+        args = ["--standalone"] + args
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", script] + args,
+                          env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:], file=sys.stderr)
+        raise subprocess.CalledProcessError(proc.returncode, args)
+    imports = [int(m.group(1)) for m in re.finditer(r'^import time:\s+(\d+) \|', proc.stderr, re.M)]
+    return(wall, sum(imports)/1e6, len(imports))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time interpreter start-up and imports of quick beanvelope commands")
+    parser.add_argument("--script", default=os.path.join(harness.repo_dir, "beanvelope.py"), help="beanvelope.py to measure [this tree]")
+    parser.add_argument("--commands", default=",".join(commands), help="Comma separated commands to time [{}]".format(",".join(commands)))
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each command [5]")
+    parser.add_argument("--client", action="store_true", default=False,
+                        help="Time beanvelope_client.py against a running serve daemon instead")
+    parser.add_argument("--output", default=None, help="Write the results to a file instead of stdout")
+    args = parser.parse_args()
+    script = os.path.join(harness.repo_dir, "beanvelope_client.py") if args.client else args.script
+
+    work = tempfile.mkdtemp(prefix="beanvelope-startup-")
+    daemon = None
+    try:
+        harness.install_fake_bean_query(os.path.join(work, "bin"))
+        ledger, answers, expenses, income, months = generate.generate_ledger(work, years=1, transactions=50, includes=2)
+        db = os.path.join(work, "budget.db")
+        generate.generate_database(db, ledger, answers, expenses, income, months)
+        home = os.path.join(work, "home")
+        os.makedirs(os.path.join(home, ".config", "beanvelope"))
+        with open(os.path.join(home, ".config", "beanvelope", "beanvelope.conf"), 'w') as f:
+            f.write("[DEFAULT]\ndb = {}\nbeanfile = {}\nbackend = bean-query\ncache = {}\n".format(
+                db, ledger, os.path.join(work, "cache.db")))
+        env = dict(os.environ, HOME=home)
+        year, month = months[-1]
+        if args.client:
+            daemon = subprocess.Popen([sys.executable, args.script, "serve"], env=env, stdout=subprocess.DEVNULL)
+            sock = os.path.join(home, ".cache", "beanvelope", "beanvelope.sock")
+            while not os.path.exists(sock):
+                time.sleep(0.05)
+        results = {}
+        for name in args.commands.split(","):
+            command = [c.format(work=work) for c in commands[name]]
+            if name != "help":
+                command += ["-m", str(month), "-y", str(year)]
+            # The first run syncs the budget; only warm runs are timed
+            run_command(script, command, env, not args.client)
+            runs = [run_command(script, command, env, not args.client) for i in range(args.repeat)]
+            results[name] = {"median": statistics.median(r[0] for r in runs),
+                             "min": min(r[0] for r in runs),
+                             "imports": statistics.median(r[1] for r in runs),
+                             "modules": runs[0][2]}
+    finally:
+        if daemon != None:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {"beanvelope": harness.version(),
+              "script": script,
+              "python": sys.version.split()[0],
+              "steps": results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
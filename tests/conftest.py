@@ -0,0 +1,54 @@
+import os
+import sys
+import sqlite3
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import beanvelope
+from bench import generate
+
+
+class ledger_fixture:
+    '''A small generated ledger and budget database in a temporary directory
+
+    The database has a closed history for every month of 2020 and an
+    active budget for 2020-12.'''
+    def __init__(self, directory):
+        self.directory = directory
+        self.beanfile, self.answers, self.expenses, self.income, self.months = generate.generate_ledger(
+            directory, accounts=5, years=1, transactions=20, includes=2)
+        self.db = os.path.join(directory, "budget.db")
+        generate.generate_database(self.db, self.beanfile, self.answers, self.expenses, self.income, self.months, corrections=2)
+        self.year, self.month = self.months[-1]
+
+    def path(self, name):
+        return(os.path.join(self.directory, name))
+
+    def budget(self, month=None, year=None, **options):
+        options.setdefault("backend", "beancount")
+        options.setdefault("lazy", True)
+        return(beanvelope.budget(self.db, self.beanfile, "", month or self.month, year or self.year, **options))
+
+    def append(self, name, text):
+        with open(self.path(name), 'a') as f:
+            f.write(text)
+
+    def replace(self, name, old, new):
+        with open(self.path(name)) as f:
+            contents = f.read()
+        assert old in contents
+        with open(self.path(name), 'w') as f:
+            f.write(contents.replace(old, new, 1))
+
+    def query(self, sql, params=()):
+        dbobject = sqlite3.connect(self.db)
+        try:
+            return(dbobject.execute(sql, params).fetchall())
+        finally:
+            dbobject.close()
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    return(ledger_fixture(str(tmp_path)))
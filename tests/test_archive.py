@@ -0,0 +1,37 @@
+import pytest
+
+import beanvelope
+
+
+def databases(b):
+    return([row[1] for row in b.read_sql('''pragma database_list''', []) if row[1] != "temp"])
+
+
+def test_archive_is_detached_when_the_block_raises(ledger):
+    b = ledger.budget()
+    with pytest.raises(ZeroDivisionError):
+        with b.attached_archive(ledger.path("archive.db")) as schema:
+            assert schema == "archive"
+            assert databases(b) == ["main", "archive"]
+            1/0
+    assert databases(b) == ["main"]
+    b.close()
+
+
+def test_carries_survive_compaction_into_an_archive(ledger, capsys):
+    archive = ledger.path("archive.db")
+    b = ledger.budget()
+    b.sync()
+    assert b.close_through(2021, 3) == 0
+    capsys.readouterr()
+    assert b.export_report("-", "csv", "planner", (2020, 1), (2021, 4), archive=archive) == 0
+    planner = capsys.readouterr().out
+    carried = b.history(archive=archive)["carried"]
+    assert b.compact_corrections(2021, 2, archive) > 0
+    assert databases(b) == ["main"]
+    assert b.audit(archive) == []
+    assert b.export_report("-", "csv", "planner", (2020, 1), (2021, 4), archive=archive) == 0
+    assert capsys.readouterr().out == planner
+    assert (b.history(archive=archive)["carried"] == carried).all()
+    assert databases(b) == ["main"]
+    b.close()
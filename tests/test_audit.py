@@ -0,0 +1,64 @@
+import sys
+
+import pytest
+
+import beanvelope
+
+
+def test_generated_database_is_clean(ledger):
+    b = ledger.budget()
+    b.sync()
+    assert b.audit() == []
+    b.close()
+
+
+def test_close_through_keeps_invariants(ledger):
+    b = ledger.budget()
+    b.sync()
+    assert b.close_through(2021, 3) == 0
+    assert b.audit() == []
+    assert (b.year, b.month) == (2021, 4)
+    b.close()
+
+
+def test_sync_range_leaves_closed_carries_alone(ledger):
+    b = ledger.budget()
+    b.sync()
+    assert b.close_through(2021, 1) == 0
+    b.close()
+    # A transaction backdated into a closed month
+    ledger.append("txns/000.beancount", '2020-06-15 * "Late"\n  Expenses:Category000  99.00 USD\n  Assets:Bank\n\n')
+    b = ledger.budget(2, 2021)
+    assert b.sync_range() == 1
+    assert b.audit() == []
+    b.close()
+
+
+def test_audit_repairs_restore_invariants(ledger):
+    b = ledger.budget()
+    b.sync()
+    b.close_through(2021, 1)
+    b.write_sql('''update corrections set correction_value = correction_value + 500
+                   where budget_id = 5 and account_id = 2 and correction_type = 'C' ''', [])
+    findings = b.audit()
+    # The tampered carry, and the next month's carry computed from it
+    assert set((f[0], f[4]) for f in findings) == {("carry", 2)}
+    b.dbobject.executescript("\n".join(b.audit_repairs(findings)))
+    assert b.audit() == []
+    b.close()
+
+
+def test_audit_command_needs_no_budget_month(ledger, monkeypatch, capsys):
+    config = ledger.path("beanvelope.conf")
+    with open(config, 'w') as f:
+        f.write("[DEFAULT]\ndb = {}\nbeanfile = {}\n".format(ledger.db, ledger.beanfile))
+    monkeypatch.setattr(beanvelope, "config_file", config)
+    # The generated history ends in 2020, so there is no budget for today
+    monkeypatch.setattr(sys, "argv", ["beanvelope", "audit"])
+    with pytest.raises(SystemExit) as e:
+        beanvelope.main()
+    assert e.value.code == None
+    assert "No budget" not in capsys.readouterr().out
+    # Auditing must not sync anything
+    assert ledger.query('''select count(*) from ledger_files''') == [(0,)]
+    assert ledger.query('''select count(*) from sync_state''') == [(0,)]
@@ -0,0 +1,31 @@
+import os
+import sqlite3
+
+import pytest
+
+import beanvelope
+
+
+def test_missing_database_is_not_created(tmp_path):
+    db = str(tmp_path / "missing.db")
+    with pytest.raises(SystemExit) as e:
+        beanvelope.budget(db, "", "", 12, 2020, backend="beancount", lazy=True)
+    assert e.value.code == 25
+    assert not os.path.exists(db)
+
+
+def test_database_without_base_schema_is_not_migrated(tmp_path):
+    db = str(tmp_path / "empty.db")
+    sqlite3.connect(db).close()
+    with pytest.raises(SystemExit) as e:
+        beanvelope.budget(db, "", "", 12, 2020, backend="beancount", lazy=True)
+    assert e.value.code == 25
+    dbobject = sqlite3.connect(db)
+    assert dbobject.execute('pragma user_version').fetchone()[0] == 0
+    assert dbobject.execute('''select count(*) from sqlite_master''').fetchone()[0] == 0
+    dbobject.close()
+
+
+def test_generated_database_is_migrated(ledger):
+    ledger.budget().close()
+    assert ledger.query('pragma user_version') == [(len(beanvelope.migrations),)]
@@ -0,0 +1,19 @@
+import beanvelope
+
+from test_sync import monthly, transaction
+
+
+def test_watch_reingests_in_place_edits(ledger):
+    server = beanvelope.budget_server(ledger.path("beanvelope.sock"), ledger.db, ledger.beanfile, "",
+                                      backend="beancount", cache=ledger.path("cache.db"))
+    ledger.append("txns/000.beancount", transaction.format(date="2020-12-20", account="Expenses:Category001", amount="555.00"))
+    b = server.budget_for(ledger.month, ledger.year)
+    before = monthly(ledger, 2020, 12, "Expenses:Category001")
+    for old, new in (("555.00", "111.00"), ("111.00", "222.00")):
+        ledger.replace("txns/000.beancount", old, new)
+        server.watch()
+        expected = before - 55500 + int(new.replace(".", ""))
+        assert monthly(ledger, 2020, 12, "Expenses:Category001") == expected
+        spending = [r[4] for r in b.envelope_balance() if r[1] == "Expenses:Category001"]
+        assert spending == [expected]
+    b.close()
@@ -0,0 +1,130 @@
+import os
+
+import beanvelope
+
+transaction = '''{date} * "Test"
+  {account}  {amount} USD
+  Assets:Bank
+
+'''
+
+
+def monthly(ledger, year, month, account):
+    rows = ledger.query('''select value from ledger_monthly
+                           where kind = 'E' and year = ? and month = ? and account_name = ?''',
+                        [year, month, account])
+    return(rows[0][0] if rows else 0)
+
+
+def synced(ledger):
+    b = ledger.budget()
+    b.sync()
+    return(b)
+
+
+def test_unchanged_after_sync(ledger):
+    b = synced(ledger)
+    assert b.ledger_changes() == "unchanged"
+    b.close()
+
+
+def test_append_is_parsed_incrementally(ledger):
+    synced(ledger).close()
+    before = monthly(ledger, 2020, 12, "Expenses:Category000")
+    ledger.append("txns/001.beancount", transaction.format(date="2020-12-15", account="Expenses:Category000", amount="12.34"))
+    b = ledger.budget()
+    changes = b.ledger_changes()
+    assert [os.path.basename(path) for path, offset, lines in changes] == ["001.beancount"]
+    entries = b.parse_appended(changes)
+    assert entries != None and len(entries) == 1
+    b.sync()
+    assert monthly(ledger, 2020, 12, "Expenses:Category000") == before + 1234
+    assert b.ledger_changes() == "unchanged"
+    b.close()
+
+
+def test_in_place_edit_rebuilds(ledger):
+    synced(ledger).close()
+    ledger.append("txns/000.beancount", transaction.format(date="2020-12-20", account="Expenses:Category001", amount="555.00"))
+    synced(ledger).close()
+    before = monthly(ledger, 2020, 12, "Expenses:Category001")
+    ledger.replace("txns/000.beancount", "555.00", "111.00")
+    b = ledger.budget()
+    assert b.ledger_changes() == "rebuild"
+    b.sync()
+    assert monthly(ledger, 2020, 12, "Expenses:Category001") == before - 44400
+    b.close()
+
+
+def test_new_include_is_not_parsed_incrementally(ledger):
+    synced(ledger).close()
+    with open(ledger.path("txns/extra.beancount"), 'w') as f:
+        f.write(transaction.format(date="2020-12-10", account="Expenses:Category002", amount="7.00"))
+    before = monthly(ledger, 2020, 12, "Expenses:Category002")
+    ledger.append("main.beancount", 'include "txns/extra.beancount"\n')
+    b = ledger.budget()
+    changes = b.ledger_changes()
+    assert changes not in ("unchanged", "rebuild")
+    assert b.parse_appended(changes) == None
+    b.sync()
+    assert monthly(ledger, 2020, 12, "Expenses:Category002") == before + 700
+    assert b.ledger_changes() == "unchanged"
+    b.close()
+
+
+def test_new_open_adds_an_envelope(ledger):
+    synced(ledger).close()
+    ledger.append("main.beancount", "2020-12-01 open Expenses:Fun\n")
+    b = ledger.budget()
+    changes = b.ledger_changes()
+    entries = b.parse_appended(changes)
+    assert [entry.account for entry in entries] == ["Expenses:Fun"]
+    b.sync()
+    assert ledger.query('''select open_date from ledger_accounts where account_name = ?''', ["Expenses:Fun"]) == [("2020-12-01",)]
+    assert ledger.query('''select count(*) from budget_base b join accounts a on a.account_id = b.account_id
+                           where a.account_name = ? and b.budget_id = ?''', ["Expenses:Fun", b.budget_id]) == [(1,)]
+    b.close()
+
+
+def test_other_beanfile_rebuilds(ledger):
+    synced(ledger).close()
+    with open(ledger.beanfile) as f:
+        contents = f.read()
+    other = ledger.path("other.beancount")
+    with open(other, 'w') as f:
+        f.write(contents)
+    b = beanvelope.budget(ledger.db, other, "", ledger.month, ledger.year, backend="beancount", lazy=True)
+    assert b.ledger_changes() == "rebuild"
+    b.close()
+
+
+def test_new_account_spending_is_loaded(ledger):
+    synced(ledger).close()
+    ledger.append("main.beancount", "2020-12-01 open Expenses:Fun\n")
+    ledger.append("txns/000.beancount", transaction.format(date="2020-12-05", account="Expenses:Fun", amount="5.00"))
+    b = ledger.budget()
+    b.ensure_synced()
+    assert [r[4] for r in b.envelope_balance() if r[1] == "Expenses:Fun"] == [500]
+    b.close()
+
+
+def test_ledger_errors_are_reported(ledger, capsys):
+    ledger.append("main.beancount", "2020-06-30 close Expenses:Category003\n")
+    ledger.append("txns/000.beancount", transaction.format(date="2020-07-05", account="Expenses:Category003", amount="5.00"))
+    synced(ledger).close()
+    err = capsys.readouterr().err
+    assert "Expenses:Category003" in err and "errors in" in err
+
+
+def test_posting_after_close_is_not_parsed_incrementally(ledger, capsys):
+    synced(ledger).close()
+    ledger.append("main.beancount", "2020-06-30 close Expenses:Category003\n")
+    synced(ledger).close()
+    assert ledger.query('''select close_date from ledger_accounts where account_name = ?''', ["Expenses:Category003"]) == [("2020-06-30",)]
+    capsys.readouterr()
+    ledger.append("txns/000.beancount", transaction.format(date="2020-12-05", account="Expenses:Category003", amount="5.00"))
+    b = ledger.budget()
+    assert b.parse_appended(b.ledger_changes()) == None
+    b.sync()
+    assert "Expenses:Category003" in capsys.readouterr().err
+    b.close()
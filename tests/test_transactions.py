@@ -0,0 +1,63 @@
+import threading
+
+
+def test_ledger_is_read_outside_the_write_lock(ledger):
+    reading = threading.Event()
+    written = threading.Event()
+
+    def sync():
+        # sqlite3 connections stay in the thread that opened them
+        a = ledger.budget()
+        query_ledger = a.query_ledger
+        def slow_query_ledger():
+            reading.set()
+            written.wait(10)
+            return(query_ledger())
+        a.query_ledger = slow_query_ledger
+        a.sync()
+        a.close()
+    worker = threading.Thread(target=sync)
+    worker.start()
+    try:
+        assert reading.wait(10)
+        b = ledger.budget()
+        b.curs.execute('pragma busy_timeout = 100')
+        assert b.set_target(1, "12.00") == 0
+        b.close()
+    finally:
+        written.set()
+        worker.join()
+    assert ledger.query('''select target from budget_base where budget_id = 12 and account_id = 1''') == [(1200,)]
+    assert ledger.query('''select count(*) from ledger_files''')[0][0] > 0
+
+
+def test_concurrent_incremental_syncs_count_once(ledger):
+    ledger.budget().sync()
+    ledger.append("txns/001.beancount", '2020-12-15 * "Test"\n  Expenses:Category000  12.34 USD\n  Assets:Bank\n\n')
+    sql = '''select value from ledger_monthly where kind = 'E' and year = 2020 and month = 12
+             and account_name = 'Expenses:Category000' '''
+    before = ledger.query(sql)[0][0]
+    reading = threading.Event()
+    written = threading.Event()
+
+    def sync():
+        a = ledger.budget()
+        parse_appended = a.parse_appended
+        def slow_parse_appended(appended):
+            reading.set()
+            written.wait(10)
+            return(parse_appended(appended))
+        a.parse_appended = slow_parse_appended
+        a.sync()
+        a.close()
+    worker = threading.Thread(target=sync)
+    worker.start()
+    try:
+        assert reading.wait(10)
+        b = ledger.budget()
+        b.sync()
+        b.close()
+    finally:
+        written.set()
+        worker.join()
+    assert ledger.query(sql)[0][0] == before + 1234